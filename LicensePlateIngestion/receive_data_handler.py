@@ -1,25 +1,127 @@
+import base64
 import json
 import boto3
 import os
 
 firehose_name = os.environ.get('FIREHOSE_NAME', 'LicensePlateDataStream')
-firehose = boto3.client('firehose')
+# Created on first use so requests that never reach Firehose don't pay for it.
+firehose = None
+
+# PutRecordBatch accepts at most 500 records and 4 MiB per call.
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+def splitPlateReads(body):
+    """Returns the plate reads in a request body as JSON strings.
+
+    The body can be a single JSON object, a JSON array of objects, or
+    newline-delimited JSON objects. Objects are passed through as they were
+    sent; only the elements of an array have to be serialized again. A
+    missing body (None, as API Gateway sends for an empty POST) is empty.
+    """
+    body = (body or '').strip()
+    if not body:
+        raise ValueError("The request body is empty.")
+    if body.startswith('['):
+        plate_reads = json.loads(body)
+        if not plate_reads or not all(isinstance(plate_read, dict) for plate_read in plate_reads):
+            raise ValueError("Expected a non-empty array of JSON objects.")
+        return [json.dumps(plate_read) for plate_read in plate_reads]
+
+    try:
+        lines = [body] if isinstance(json.loads(body), dict) else None
+    except json.JSONDecodeError:
+        # More than one value, so it has to be newline-delimited JSON.
+        lines = [line.strip() for line in body.splitlines() if line.strip()]
+        if not all(isinstance(json.loads(line), dict) for line in lines):
+            lines = None
+    if not lines:
+        raise ValueError("Expected a JSON object, an array of objects or newline-delimited objects.")
+    return lines
+
+def batchRecords(records):
+    """Groups Firehose records into PutRecordBatch calls within the record and size limits."""
+    batch = []
+    batch_bytes = 0
+    for record in records:
+        if batch and (len(batch) == MAX_BATCH_RECORDS or batch_bytes + len(record['Data']) > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += len(record['Data'])
+    if batch:
+        yield batch
+
+def getFirehoseClient():
+    """Returns the Firehose client, creating it on first use."""
+    global firehose
+    if firehose is None:
+        firehose = boto3.client('firehose')
+    return firehose
+
+def sendToFirehose(plate_reads):
+    """Sends plate reads to Firehose in batches and returns the indices of those that could not be delivered.
+
+    Records a batch call rejects are retried one at a time with PutRecord.
+    """
+    # The parse service expects every record to end with ",\n".
+    records = [{'Data': (plate_read + ',\n').encode('utf-8')} for plate_read in plate_reads]
+    firehose = getFirehoseClient()
+    failed = []
+    # Batches are consecutive runs of records, so offset is the index of a batch's first record.
+    offset = 0
+    for batch in batchRecords(records):
+        try:
+            response = firehose.put_record_batch(
+                DeliveryStreamName=firehose_name,
+                Records=batch
+            )
+        except Exception:
+            # Earlier batches were delivered, so only this one is reported as failed.
+            failed.extend(range(offset, offset + len(batch)))
+            offset += len(batch)
+            continue
+        if response.get('FailedPutCount'):
+            for i, (record, result) in enumerate(zip(batch, response['RequestResponses'])):
+                if 'ErrorCode' not in result:
+                    continue
+                try:
+                    firehose.put_record(
+                        DeliveryStreamName=firehose_name,
+                        Record=record
+                    )
+                except Exception:
+                    failed.append(offset + i)
+        offset += len(batch)
+    return failed
 
 def receivelprdata(event, context):
     try:
-        data = json.loads(event['body'])
-        firehose.put_record(
-            DeliveryStreamName=firehose_name,
-            Record={
-                'Data': json.dumps(data) + ',\n'
-            }
-        )
+        body = event.get('body')
+        if body and event.get('isBase64Encoded'):
+            body = base64.b64decode(body).decode('utf-8')
+
+        try:
+            plate_reads = splitPlateReads(body)
+        except ValueError as e:
+            return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+
+        failed = sendToFirehose(plate_reads)
+        if len(failed) == len(plate_reads):
+            raise RuntimeError(f"None of the {len(plate_reads)} records could be sent to firehose")
+
         body = {
             "message": "Data sent to firehose",
+            "records": len(plate_reads),
         }
-        response = {"statusCode": 200, "body": json.dumps(body)}
+        if failed:
+            # The other records were delivered, so the client must only resend these.
+            body["message"] = f"{len(failed)} of {len(plate_reads)} records could not be sent to firehose"
+            body["failed_records"] = failed
+        response = {"statusCode": 207 if failed else 200, "body": json.dumps(body)}
     except Exception as e:
         response = {"statusCode": 500, "body": json.dumps({"error": str(e)})}
 
 
-    return response
\ No newline at end of file
+    return response
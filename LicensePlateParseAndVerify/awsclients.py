@@ -0,0 +1,92 @@
+"""Lazily created AWS clients for the handlers.
+
+Creating a boto3 client or resource loads its service model, which is a large
+part of a cold start, so the handler modules no longer create any at import
+time. Each client is created the first time a code path needs it and reused
+for the life of the container. Creation is guarded by a lock because the
+parse and verify steps use clients from worker threads.
+
+Low-level clients are thread-safe and shared by every thread. boto3
+resources are not, so resource() and table() give each thread its own
+objects, built around the one shared client of the service. ThreadLocalTable
+stands in for table() in objects that are shared between threads.
+"""
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+_clients = {}
+_lock = threading.RLock()
+_local = threading.local()
+
+
+def _cached(key, create):
+    cached = _clients.get(key)
+    if cached is None:
+        with _lock:
+            cached = _clients.get(key)
+            if cached is None:
+                cached = _clients[key] = create()
+    return cached
+
+
+def client(service_name, max_pool_connections=None):
+    """Returns the shared low-level client for service_name.
+
+    max_pool_connections only applies when the client is first created.
+    """
+    def create():
+        if max_pool_connections is None:
+            return boto3.client(service_name)
+        return boto3.client(service_name, config=Config(max_pool_connections=max_pool_connections))
+    return _cached(('client', service_name), create)
+
+
+def _per_thread(key, create):
+    installed = _clients.get(('installed',) + key)
+    if installed is not None:
+        return installed
+    objects = getattr(_local, 'objects', None)
+    if objects is None:
+        objects = _local.objects = {}
+    cached = objects.get(key)
+    if cached is None:
+        cached = objects[key] = create()
+    return cached
+
+
+def resource(service_name):
+    """Returns the calling thread's boto3 resource for service_name."""
+    def create():
+        shared = _cached(('resource', service_name), lambda: boto3.resource(service_name))
+        # A new resource object is cheap when it reuses the shared client.
+        return type(shared)(client=shared.meta.client)
+    return _per_thread(('resource', service_name), create)
+
+
+def table(env_var):
+    """Returns the calling thread's DynamoDB Table whose name is in the environment variable env_var."""
+    return _per_thread(('table', env_var), lambda: resource('dynamodb').Table(os.environ[env_var]))
+
+
+class ThreadLocalTable:
+    """Forwards every attribute to table(env_var) of the calling thread."""
+
+    def __init__(self, env_var):
+        self.env_var = env_var
+
+    def __getattr__(self, name):
+        return getattr(table(self.env_var), name)
+
+
+def install(kind, name, obj):
+    """Uses obj as the 'client', 'resource' or 'table' for name, in every thread.
+
+    Lets the local replay harness run the handlers against in-memory fakes.
+    """
+    with _lock:
+        _clients[(kind, name)] = obj
+        if kind != 'client':
+            _clients[('installed', kind, name)] = obj
@@ -0,0 +1,115 @@
+"""Coalescing of repeated plate reads in the parse step.
+
+A camera often reports the same vehicle several times within a few seconds.
+ReadCoalescer groups reads by camera label and normalized plate: a read that
+comes within window_ms of the first read of its group is a repeat and gets
+no LprDataTable row of its own. The window is measured from the first read,
+not the latest, so a vehicle that stays in front of a camera still gets a new
+row every window_ms and a real exit and re-entry is never swallowed.
+
+When a repeat has a higher best_confidence than the item stored for its
+group, that item is rewritten with the repeat's plate, candidates and crops
+(keeping the stored crops the repeat lacks), but keeps its plate_read_id and
+plate_read_timestamp, so the verify step still sees a single read. Only items
+created in the current batch() are rewritten: their keys are not announced
+until the batch is written, while an item from an earlier batch may already
+have been verified.
+
+Groups live for the life of the container, so repeats split across Firehose
+files are coalesced too. A group is forgotten once window_ms has passed
+between its first read and the newest read seen, and at most max_groups
+groups are kept.
+"""
+import contextlib
+import os
+from collections import OrderedDict
+
+from platematching import normalize_plate
+
+# 0 turns coalescing off.
+WINDOW_MS = int(os.environ.get('COALESCE_WINDOW_MS', 10 * 1000))
+MAX_GROUPS = int(os.environ.get('COALESCE_MAX_GROUPS', 10000))
+
+# Written by PlateReadWriter; a rewrite keeps the stored ones the better read has no crop for.
+CROP_URL_FIELDS = ('plate_crop_jpeg_url', 'vehicle_crop_jpeg_url')
+
+# What coalesce() found a read to be.
+NEW = 'new'
+REPEAT = 'repeat'
+IMPROVED = 'improved'
+
+
+def _confidence(item):
+    confidence = item.get('best_confidence')
+    return confidence if confidence is not None else -1
+
+
+class ReadCoalescer:
+    """Recent reads per (camera label, normalized plate)."""
+
+    def __init__(self, window_ms=WINDOW_MS, max_groups=MAX_GROUPS):
+        self.window_ms = window_ms
+        self.max_groups = max_groups
+        # Key -> [stored item, timestamp of the group's first read, batch it was created in], oldest first.
+        self._groups = OrderedDict()
+        self._newest = None
+        self._batch = 0
+
+    def __len__(self):
+        return len(self._groups)
+
+    def clear(self):
+        self._groups.clear()
+        self._newest = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Forgets every group if the with-block fails, since their items may not have been written."""
+        self._batch += 1
+        try:
+            yield self
+        except BaseException:
+            self.clear()
+            raise
+
+    def _evict(self):
+        while self._groups:
+            _, first_seen, _ = next(iter(self._groups.values()))
+            if len(self._groups) <= self.max_groups and first_seen >= self._newest - self.window_ms:
+                break
+            self._groups.popitem(last=False)
+
+    def coalesce(self, item):
+        """Returns (NEW, item), (IMPROVED, rewritten stored item) or (REPEAT, None) for a parsed read.
+
+        Only NEW items should be announced to the verify step.
+        """
+        timestamp = item.get('plate_read_timestamp')
+        plate = item.get('best_plate_number')
+        if not self.window_ms or timestamp is None or not plate:
+            return NEW, item
+
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+        key = (item.get('camera_label'), normalize_plate(plate))
+        group = self._groups.get(key)
+
+        if group is None or abs(timestamp - group[1]) > self.window_ms:
+            self._groups[key] = [item, timestamp, self._batch]
+            self._groups.move_to_end(key)
+            self._evict()
+            return NEW, item
+
+        stored, _, created_in = group
+        self._evict()
+        if created_in != self._batch or _confidence(item) <= _confidence(stored):
+            return REPEAT, None
+
+        improved = dict(item)
+        for field in ('plate_read_id', 'plate_read_timestamp', 'epoch_start'):
+            improved[field] = stored.get(field)
+        for field in CROP_URL_FIELDS:
+            if improved.get(field) is None and stored.get(field) is not None:
+                improved[field] = stored[field]
+        group[0] = improved
+        return IMPROVED, improved
@@ -0,0 +1,14 @@
+#!/bin/sh
+# Builds the registered plate snapshot, deploys the service with it packaged, and publishes it
+# to the stack's PlateSnapshotBucket. Extra arguments go to serverless deploy, e.g.:
+#
+#     STAGE=prod ./deploy.sh --stage prod
+set -eu
+cd "$(dirname "$0")"
+
+python platesnapshot.py Registered_License_Plates.txt camera_roles.json registered_plates.snapshot
+serverless deploy "$@"
+
+BUCKET=$(aws cloudformation describe-stacks --stack-name "lprparseandverify-${STAGE:-dev}" \
+    --query "Stacks[0].Outputs[?OutputKey=='PlateSnapshotBucketName'].OutputValue" --output text)
+aws s3 cp registered_plates.snapshot "s3://$BUCKET/registered_plates.snapshot"
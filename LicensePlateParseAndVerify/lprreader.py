@@ -0,0 +1,53 @@
+"""Streaming reader for the plate read files Firehose delivers to S3.
+
+The ingestion service writes every plate read as a JSON object followed by
+",\n", so a delivered file is a run of objects separated by commas and
+whitespace. iterPlateReads decodes one object at a time from a file-like
+body, reading it in chunks, so memory stays bounded by the largest single
+read rather than the whole file. Floats are decoded as decimal.Decimal,
+which is what DynamoDB expects.
+"""
+import codecs
+import decimal
+import json
+
+from metrics import metrics
+
+CHUNK_SIZE = 256 * 1024
+SEPARATORS = ' \t\r\n,'
+
+_decoder = json.JSONDecoder(parse_float=decimal.Decimal)
+
+
+def iterPlateReads(body, chunk_size=CHUNK_SIZE):
+    """Yields each plate read dict in a delivered file, in file order."""
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    at_end = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in SEPARATORS:
+            position += 1
+
+        if position < len(buffer):
+            try:
+                with metrics.timer('decode'):
+                    plate_read, position = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Most likely the object is cut off at the end of the buffer.
+                if at_end:
+                    raise
+            else:
+                if not isinstance(plate_read, dict):
+                    raise ValueError(f"Expected a plate read object, got {type(plate_read).__name__}.")
+                yield plate_read
+                continue
+        elif at_end:
+            return
+
+        with metrics.timer('s3_read'):
+            chunk = body.read(chunk_size)
+        at_end = not chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk or b'', final=at_end)
+        position = 0
@@ -0,0 +1,131 @@
+"""Per-invocation timings and counters for the parse and verify handlers.
+
+Code on the hot path records into the shared `metrics` object:
+
+    with metrics.timer('dynamodb_read'):
+        response = table.query(...)
+    metrics.count('dynamodb_calls')
+
+Timers add up the wall time spent in a stage and counters add up events.
+Both are safe to use from worker threads; time spent in concurrent threads is
+summed, so a timer can exceed the invocation time. Handlers decorated with
+@instrumented write everything recorded during the call as a single
+CloudWatch embedded metric format (EMF) line on stdout when they return, and
+start the next call from zero.
+
+Set LPR_PROFILE=1 to also run each invocation under cProfile. The slowest
+functions by cumulative time are logged and the full profile is written to
+/tmp/<function>.prof.
+"""
+import contextlib
+import functools
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'LicensePlateParseAndVerify')
+PROFILE_LINES = 30
+
+logger = logging.getLogger()
+
+
+class Metrics:
+    """Thread-safe timers and counters, flushed once per invocation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._counters = {}
+
+    def reset(self):
+        with self._lock:
+            self._timers = {}
+            self._counters = {}
+
+    def add_time(self, name, milliseconds):
+        with self._lock:
+            self._timers[name] = self._timers.get(name, 0.0) + milliseconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Adds the time spent in the with-block to the timer name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, (time.perf_counter() - started) * 1000)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def value(self, name):
+        """Returns the current value of a counter, or 0."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def flush(self, function_name):
+        """Returns the recorded metrics as an EMF document and resets them."""
+        with self._lock:
+            timers, counters = self._timers, self._counters
+            self._timers, self._counters = {}, {}
+
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': f'{name}_ms', 'Unit': 'Milliseconds'} for name in timers]
+                        + [{'Name': name, 'Unit': 'Count'} for name in counters],
+                }],
+            },
+            'Function': function_name,
+        }
+        document.update({f'{name}_ms': round(value, 3) for name, value in timers.items()})
+        document.update(counters)
+        return document
+
+
+metrics = Metrics()
+
+
+def _log_profile(profiler, function_name):
+    import pstats
+
+    profiler.dump_stats(os.path.join('/tmp', f'{function_name}.prof'))
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    logger.info(f"Profile of {function_name}:\n{output.getvalue()}")
+
+
+def instrumented(function_name):
+    """Decorates a Lambda handler so its metrics are written once per invocation."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            profiler = None
+            if os.environ.get('LPR_PROFILE'):
+                # Only imported when asked for, to keep it off the cold start.
+                import cProfile
+                profiler = cProfile.Profile()
+            metrics.reset()
+            started = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                return handler(event, context)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    _log_profile(profiler, function_name)
+                metrics.add_time('invocation', (time.perf_counter() - started) * 1000)
+                # EMF lines have to be bare JSON, so they bypass the Lambda log formatter.
+                sys.stdout.write(json.dumps(metrics.flush(function_name)) + '\n')
+                sys.stdout.flush()
+        return wrapper
+    return decorate
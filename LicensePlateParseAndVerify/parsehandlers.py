@@ -1,22 +1,25 @@
 import json
 import logging
 import os
-import decimal
 import uuid
 import datetime
-import base64
 
-import boto3
+import awsclients
+from coalescer import IMPROVED, REPEAT, ReadCoalescer
+from lprreader import iterPlateReads
+from metrics import instrumented, metrics
+from platewriter import PlateReadWriter
+
+IMAGE_UPLOAD_WORKERS = int(os.environ.get('IMAGE_UPLOAD_WORKERS', 16))
+# Reads announced per completed-queue message, so a verify batch is sized in reads rather than files.
+COMPLETED_MESSAGE_READS = int(os.environ.get('COMPLETED_MESSAGE_READS', 100))
 
-s3 = boto3.client('s3')
-sqs = boto3.client('sqs')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['LPR_DYNAMODB_TABLE'])
-image_bucket_name = os.environ['IMAGE_BUCKET_NAME']
-completed_queue_url = os.environ['COMPLETED_QUEUE_URL']
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Kept for the life of the container so repeats split across files are coalesced.
+_read_coalescer = None
+
 def getDaysSinceEpoch():
     """Calculates the number of full days since the Unix epoch (1970-01-01) in UTC."""
     # Get the current time as a timezone-aware object in UTC
@@ -30,126 +33,118 @@ def getDaysSinceEpoch():
     
     return days_since_epoch
 
+def decimalToJson(value):
+    """json.dumps default for the Decimals DynamoDB items hold: integral values stay ints."""
+    return int(value) if value == value.to_integral_value() else float(value)
+
+def getReadCoalescer():
+    """Returns the repeated read coalescer, creating it on first use."""
+    global _read_coalescer
+    if _read_coalescer is None:
+        _read_coalescer = ReadCoalescer()
+    return _read_coalescer
 
+@instrumented('parse')
 def receivelprdata(event, context):
     logger.info(f"Received event: {json.dumps(event)}")
 
-    processed_item_guids = []
-
-    for record in event['Records']:
-        # The message body from S3 notification is a string, so it needs to be parsed as JSON
-        s3_notification = json.loads(record['body'])
-        
-        # Check to see if the s3 records exist
-        if 'Records' not in s3_notification:
-            logger.info(f"No files found in S3 event notification.")
-            return {
-                'statusCode': 200,
-                'body': json.dumps('Successfully processed S3 event(s).')
-            }
-
-        # S3 notifications can contain multiple records
-        for s3_record in s3_notification['Records']:
-            bucket_name = s3_record['s3']['bucket']['name']
-            object_key = s3_record['s3']['object']['key']
-
-            logger.info(f"Processing file {object_key} from bucket {bucket_name}")
-
-            try:
-                s3_object = s3.get_object(Bucket=bucket_name, Key=object_key)
-                file_content = s3_object['Body'].read().decode('utf-8')
-                # 1. Remove trailing comma, being mindful of whitespace
-                # strip() removes leading/trailing whitespace.
-                file_content = file_content.strip()
-                if file_content.endswith(','):
-                    file_content = file_content[:-1]
-
-                # 2. Prepend '[' and append ']' to make it a valid JSON array string
-                json_array_string = '[' + file_content + ']'
-
-                # 3. Parse the modified string
-                data = json.loads(json_array_string, parse_float=decimal.Decimal)
-                
-                logger.info(f"File content: {json.dumps(data, default=str)}")
-
-                for plate_data in data:
-                    plate_crop_jpeg_url = None
-                    if plate_data.get('best_plate', {}).get('plate_crop_jpeg'):
-                        try:
-                            plate_image_data = base64.b64decode(plate_data['best_plate']['plate_crop_jpeg'])
-                            plate_image_key = f"plate_images/{str(uuid.uuid4())}.jpg"
-                            s3.put_object(
-                                Bucket=image_bucket_name,
-                                Key=plate_image_key,
-                                Body=plate_image_data,
-                                ContentType='image/jpeg'
-                            )
-                            plate_crop_jpeg_url = f"https://{image_bucket_name}.s3.amazonaws.com/{plate_image_key}"
-                        except (base64.binascii.Error, TypeError) as e:
-                            logger.error(f"Error decoding or uploading plate_crop_jpeg: {e}")
-
-                    vehicle_crop_jpeg_url = None
-                    if plate_data.get('vehicle_crop_jpeg'):
-                        try:
-                            vehicle_image_data = base64.b64decode(plate_data['vehicle_crop_jpeg'])
-                            vehicle_image_key = f"vehicle_images/{str(uuid.uuid4())}.jpg"
-                            s3.put_object(
-                                Bucket=image_bucket_name,
-                                Key=vehicle_image_key,
-                                Body=vehicle_image_data,
-                                ContentType='image/jpeg'
-                            )
-                            vehicle_crop_jpeg_url = f"https://{image_bucket_name}.s3.amazonaws.com/{vehicle_image_key}"
-                        except (base64.binascii.Error, TypeError) as e:
-                            logger.error(f"Error decoding or uploading vehicle_crop_jpeg: {e}")
-
-                    item_guid = str(uuid.uuid4())
-                    item = {
-                        'plate_read_id': item_guid,
-                        'plate_read_timestamp': plate_data.get('epoch_start'),
-                        'epoch_start': plate_data.get('epoch_start'),
-                        'best_plate_number': plate_data.get('best_plate_number'),
-                        'best_confidence': plate_data.get('best_confidence'),
-                        'candidates': plate_data.get('candidates'),
-                        'best_region': plate_data.get('best_region'),
-                        'vehicle': plate_data.get('vehicle'),
-                        'days_since_epoch': getDaysSinceEpoch(),
-                        'plate_crop_jpeg_url': plate_crop_jpeg_url,
-                        'vehicle_crop_jpeg_url': vehicle_crop_jpeg_url
-                    }
-                    
-                    # Safely get camera_label
-                    if 'web_server_config' in plate_data and 'camera_label' in plate_data['web_server_config']:
-                        item['camera_label'] = plate_data['web_server_config']['camera_label']
-
-                    # Add TTL of 60 days from now
-                    ttl_timestamp = int((datetime.datetime.now() + datetime.timedelta(days=60)).timestamp())
-                    item['ttl'] = ttl_timestamp
-
-                    # Remove keys with None values before inserting into DynamoDB
-                    item_to_insert = {k: v for k, v in item.items() if v is not None}
-
-                    #logger.info(f"Putting item in DynamoDB: {json.dumps(item_to_insert, default=str)}")
-                    table.put_item(Item=item_to_insert)
-                    processed_item_guids.append(item_guid)
-
-                
-                
-            except Exception as e:
-                logger.error(f"Error processing file {object_key}: {e}")
-                # Depending on the use case, you might want to handle this differently
-                # For example, move the message to a Dead Letter Queue (DLQ)
-                raise e
-
-    if processed_item_guids:
+    # One pooled connection per upload thread.
+    s3 = awsclients.client('s3', max_pool_connections=IMAGE_UPLOAD_WORKERS)
+    table = awsclients.table('LPR_DYNAMODB_TABLE')
+    image_bucket_name = os.environ['IMAGE_BUCKET_NAME']
+
+    # Repeats are dropped before their crops are uploaded. If anything fails the
+    # coalescer starts over, since the items it remembers may not have been written.
+    coalescer = getReadCoalescer()
+    with coalescer.batch(), PlateReadWriter(s3, table, image_bucket_name, max_workers=IMAGE_UPLOAD_WORKERS) as writer:
+        for record in event['Records']:
+            # The message body from S3 notification is a string, so it needs to be parsed as JSON
+            s3_notification = json.loads(record['body'])
+            
+            # Check to see if the s3 records exist
+            if 'Records' not in s3_notification:
+                logger.info(f"No files found in S3 event notification.")
+                continue
+
+            # S3 notifications can contain multiple records
+            for s3_record in s3_notification['Records']:
+                bucket_name = s3_record['s3']['bucket']['name']
+                object_key = s3_record['s3']['object']['key']
+
+                logger.info(f"Processing file {object_key} from bucket {bucket_name}")
+
+                try:
+                    with metrics.timer('s3_read'):
+                        s3_object = s3.get_object(Bucket=bucket_name, Key=object_key)
+                    metrics.count('s3_calls')
+                    # Decode the reads one at a time straight off the S3 body.
+                    read_count = 0
+                    coalesced_count = 0
+                    for plate_data in iterPlateReads(s3_object['Body']):
+                        read_count += 1
+                        item_guid = str(uuid.uuid4())
+                        item = {
+                            'plate_read_id': item_guid,
+                            'plate_read_timestamp': plate_data.get('epoch_start'),
+                            'epoch_start': plate_data.get('epoch_start'),
+                            'best_plate_number': plate_data.get('best_plate_number'),
+                            'best_confidence': plate_data.get('best_confidence'),
+                            'candidates': plate_data.get('candidates'),
+                            'best_region': plate_data.get('best_region'),
+                            'vehicle': plate_data.get('vehicle'),
+                            'days_since_epoch': getDaysSinceEpoch(),
+                        }
+                        
+                        # Safely get camera_label
+                        if 'web_server_config' in plate_data and 'camera_label' in plate_data['web_server_config']:
+                            item['camera_label'] = plate_data['web_server_config']['camera_label']
+
+                        # Add TTL of 60 days from now
+                        ttl_timestamp = int((datetime.datetime.now() + datetime.timedelta(days=60)).timestamp())
+                        item['ttl'] = ttl_timestamp
+
+                        kind, item = coalescer.coalesce(item)
+                        if kind == REPEAT:
+                            coalesced_count += 1
+                            continue
+                        if kind == IMPROVED:
+                            # A better read of a vehicle that already has a row; rewrite the row in place.
+                            metrics.count('plate_reads_improved')
+
+                        # The crops are uploaded in the background; the writer fills in their URLs
+                        # and queues the item for the next DynamoDB batch.
+                        writer.add(
+                            item,
+                            plate_crop_jpeg=plate_data.get('best_plate', {}).get('plate_crop_jpeg'),
+                            vehicle_crop_jpeg=plate_data.get('vehicle_crop_jpeg'),
+                            announce=kind != IMPROVED
+                        )
+
+                    metrics.count('plate_reads', read_count)
+                    metrics.count('plate_reads_coalesced', coalesced_count)
+                    logger.info(f"Parsed {read_count} plate reads from file {object_key}, {coalesced_count} of them repeats.")
+
+                except Exception as e:
+                    logger.error(f"Error processing file {object_key}: {e}")
+                    # Depending on the use case, you might want to handle this differently
+                    # For example, move the message to a Dead Letter Queue (DLQ)
+                    raise e
+
+    # Only announce the reads once every item and image has been written.
+    # The verify step fetches the items back with BatchGetItem, which needs the full key.
+    processed_item_keys = writer.keys
+
+    if processed_item_keys:
         try:
-            message_body = json.dumps(processed_item_guids)
-            sqs.send_message(
-                QueueUrl=completed_queue_url,
-                MessageBody=message_body,
-                DelaySeconds=30,
-            )
-            logger.info(f"Sent {len(processed_item_guids)} item GUIDs to completed queue.")
+            for i in range(0, len(processed_item_keys), COMPLETED_MESSAGE_READS):
+                message_body = json.dumps(processed_item_keys[i:i + COMPLETED_MESSAGE_READS], default=decimalToJson)
+                with metrics.timer('sqs_send'):
+                    awsclients.client('sqs').send_message(
+                        QueueUrl=os.environ['COMPLETED_QUEUE_URL'],
+                        MessageBody=message_body,
+                        DelaySeconds=30,
+                    )
+            logger.info(f"Sent {len(processed_item_keys)} item keys to completed queue.")
         except Exception as e:
             logger.error(f"Error sending message to completed queue: {e}")
             raise e
@@ -0,0 +1,51 @@
+"""Grouping of plate reads that may belong to the same vehicle.
+
+verifylprdata runs groups concurrently but the reads of one group in order,
+so an entrance that opens a valet ticket is always handled before the exit
+that charges it. Two reads end up in the same group when they share a token:
+
+- the canonical key (platematching.canonical_plate) of any of their OCR
+  candidates, which covers every exact and confusion-equivalent match, and
+- the canonical key of their best plate or one of its single-character
+  deletions, which covers every pair of best plates within edit distance one.
+
+That is everything PlateIndex.find_any can match on. Tokens can also join
+reads that would never match; those just lose some concurrency.
+"""
+from platematching import canonical_plate, normalize_plate
+
+
+def plate_tokens(plates):
+    """Returns the grouping tokens of a read from its candidate plates, best first."""
+    keys = [canonical_plate(normalize_plate(plate)) for plate in plates if plate]
+    tokens = {('candidate', key) for key in keys}
+    if keys:
+        best = keys[0]
+        tokens.add(('best', best))
+        tokens.update(('best', best[:i] + best[i + 1:]) for i in range(len(best)))
+    return tokens
+
+
+def group_related(reads, tokens_of):
+    """Splits reads into groups that share no token, keeping each group in the order of reads."""
+    parent = list(range(len(reads)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owners = {}
+    for i, read in enumerate(reads):
+        for token in tokens_of(read):
+            j = owners.setdefault(token, i)
+            if j != i:
+                root_i, root_j = root(i), root(j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i, read in enumerate(reads):
+        groups.setdefault(root(i), []).append(read)
+    return list(groups.values())
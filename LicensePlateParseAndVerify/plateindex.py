@@ -0,0 +1,159 @@
+"""In-memory fuzzy index over license plate numbers.
+
+Plates are normalized with platematching.normalize_plate (lower case, dashes
+and spaces removed). An exact hit is a single dict probe. Plates within edit
+distance one are found through a deletion neighbourhood: every plate is also
+filed under each string obtained by deleting one of its characters, so a
+lookup only probes the query and its own deletions and then verifies the
+handful of keys that come back.
+
+Plates are also filed under their canonical key
+(platematching.canonical_plate), which folds the characters the OCR
+confuses. find_any uses it to check every OCR candidate of a read with one
+probe each. A canonical hit only counts when the keys differ in at most
+MAX_CONFUSED_CHARACTERS characters. Only when no candidate hits does find_any
+fall back to the distance-one search for the best candidate.
+"""
+
+from metrics import metrics
+from platematching import (MAX_CONFUSED_CHARACTERS, canonical_plate, confused_characters, normalize_plate,
+                           within_distance)
+
+
+def _deletions(key):
+    return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+
+class PlateIndex:
+    """Exact and distance-one lookups over a set of plate numbers.
+
+    Each entry is a value filed under a plate number with a rank. When several
+    entries match a query the one with the lowest rank wins, so building the
+    index in file order reproduces a first-match linear scan. The value
+    defaults to the plate number itself.
+    """
+
+    def __init__(self, plates=()):
+        self._entries = {}
+        self._neighbours = {}
+        self._canonical = {}
+        self._size = 0
+        for rank, plate in enumerate(plates):
+            self.add(plate, rank)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, plate, rank, value=None):
+        """Indexes value under the normalized plate, keeping the lowest rank for a repeated value."""
+        if value is None:
+            value = plate
+        key = normalize_plate(plate)
+        values = self._entries.get(key)
+        if values is None:
+            values = self._entries[key] = {}
+            for deletion in _deletions(key):
+                self._neighbours.setdefault(deletion, set()).add(key)
+            self._canonical.setdefault(canonical_plate(key), set()).add(key)
+        if value not in values:
+            self._size += 1
+        elif values[value] <= rank:
+            return
+        values[value] = rank
+
+    def remove(self, plate, value=None):
+        """Removes value from under the normalized plate, if it is there."""
+        if value is None:
+            value = plate
+        key = normalize_plate(plate)
+        values = self._entries.get(key)
+        if values is None or value not in values:
+            return
+        del values[value]
+        self._size -= 1
+        if not values:
+            del self._entries[key]
+            for deletion in _deletions(key):
+                neighbours = self._neighbours[deletion]
+                neighbours.discard(key)
+                if not neighbours:
+                    del self._neighbours[deletion]
+            canonical = canonical_plate(key)
+            self._canonical[canonical].discard(key)
+            if not self._canonical[canonical]:
+                del self._canonical[canonical]
+
+    def candidates(self, key):
+        """Returns the indexed keys that may be within distance one of key."""
+        keys = set(self._neighbours.get(key, ()))
+        if key in self._entries:
+            keys.add(key)
+        for deletion in _deletions(key):
+            if deletion in self._entries:
+                keys.add(deletion)
+            keys.update(self._neighbours.get(deletion, ()))
+        return keys
+
+    def matches(self, plate):
+        """Yields (value, rank) for every entry within distance one of plate."""
+        key = normalize_plate(plate)
+        candidates = self.candidates(key)
+        metrics.count('plate_comparisons', len(candidates))
+        for candidate in candidates:
+            if within_distance(candidate, key):
+                yield from self._entries[candidate].items()
+
+    def find(self, plate):
+        """Returns the lowest-ranked value within distance one of plate, or None."""
+        best_value, best_rank = None, None
+        for value, rank in self.matches(plate):
+            if best_rank is None or rank < best_rank:
+                best_value, best_rank = value, rank
+        return best_value
+
+    def find_any(self, plates, accept=None):
+        """Returns the best value matching any of the candidate plates, or None.
+
+        plates are the OCR candidates of one read, most likely first. An exact
+        match beats one that only agrees up to confused characters, which may
+        differ in at most MAX_CONFUSED_CHARACTERS of them. Both beat a
+        distance-one match of the first candidate, which is only looked for
+        when neither exists. Ties go to the earlier candidate, then to the
+        fewer differing characters, then to the lower rank. When accept is
+        given, only values it returns True for are considered.
+        """
+        keys = []
+        for plate in plates:
+            key = normalize_plate(plate) if plate else ''
+            if key and key not in keys:
+                keys.append(key)
+        if not keys:
+            return None
+
+        best_value, best_order = None, None
+        for position, key in enumerate(keys):
+            indexed_keys = self._canonical.get(canonical_plate(key), ())
+            for indexed in indexed_keys:
+                if indexed == key:
+                    tier, distance = 0, 0
+                else:
+                    tier = 1
+                    # Canonical keys only collide for plates of the same length, so
+                    # the characters that differ are the distance.
+                    distance = confused_characters(key, indexed)
+                    if distance > MAX_CONFUSED_CHARACTERS:
+                        continue
+                for value, rank in self._entries[indexed].items():
+                    order = (tier, position, distance, rank)
+                    if (best_order is None or order < best_order) and (accept is None or accept(value)):
+                        best_value, best_order = value, order
+            if len(indexed_keys) > 1:
+                metrics.count('plate_comparisons', len(indexed_keys))
+        if best_order is not None:
+            return best_value
+
+        best_rank = None
+        for value, rank in self.matches(keys[0]):
+            if (best_rank is None or rank < best_rank) and (accept is None or accept(value)):
+                best_value, best_rank = value, rank
+        return best_value
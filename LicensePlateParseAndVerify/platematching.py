@@ -0,0 +1,224 @@
+"""Threshold-bounded edit distance for plate matching.
+
+Every plate comparison in this service only asks "is the distance at most k?"
+(k is 1 everywhere today), so the kernels here stop as soon as the answer is
+known instead of filling the whole dynamic-programming matrix. Distances
+larger than k are reported as k + 1.
+
+batch_bounded_levenshtein compares one plate against many in a single call.
+It is vectorized with NumPy when NumPy is available and falls back to the
+scalar kernel otherwise, so the Lambda package does not depend on it.
+"""
+import os
+
+_numpy = None
+
+
+def _import_numpy():
+    """Imports NumPy on first use, since the handlers never need it; returns None if it is missing."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:  # NumPy is optional; the scalar kernel is used instead.
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def normalize_plate(plate):
+    """Normalizes a plate number for comparison (lower case, no dashes or spaces)."""
+    return plate.lower().replace('-', '').replace(' ', '')
+
+
+def candidate_plates(item):
+    """Returns the plate numbers a read may be, most likely first: best_plate_number, then its OCR candidates."""
+    plates = [item.get('best_plate_number')]
+    for candidate in item.get('candidates') or []:
+        if isinstance(candidate, dict):
+            plates.append(candidate.get('plate'))
+    return [plate for plate in plates if plate]
+
+
+# Characters the OCR commonly mistakes for each other, folded onto one
+# representative: 0/O/D/Q, 1/I/L, 2/Z, 5/S and 8/B.
+CONFUSION_CLASSES = ('0odq', '1il', '2z', '5s', '8b')
+_fold_confusions = str.maketrans({
+    character: confusion_class[0]
+    for confusion_class in CONFUSION_CLASSES
+    for character in confusion_class[1:]
+})
+
+
+def canonical_plate(key):
+    """Folds a normalized plate number by CONFUSION_CLASSES.
+
+    Plates with the same canonical key have the same length and only differ
+    in characters the OCR confuses, so e.g. KN085D, KNO8SD and KND85D share
+    one key.
+    """
+    return key.translate(_fold_confusions)
+
+
+# How many confused characters a canonical match may differ in, the same bound
+# as the distance-one match.
+MAX_CONFUSED_CHARACTERS = int(os.environ.get('MAX_CONFUSED_CHARACTERS', 1))
+
+
+def confused_characters(key, other):
+    """Returns how many characters two keys with the same canonical key differ in."""
+    return sum(a != b for a, b in zip(key, other))
+
+
+def _within_one(s1, s2):
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    length_difference = len(s1) - len(s2)
+    if length_difference > 1:
+        return False
+
+    # Skip the common prefix, then the remainders have to line up exactly.
+    i = 0
+    while i < len(s2) and s1[i] == s2[i]:
+        i += 1
+    if length_difference == 1:
+        return s1[i + 1:] == s2[i:]
+    return s1[i + 1:] == s2[i + 1:]
+
+
+def bounded_levenshtein(s1, s2, k):
+    """Returns the edit distance between s1 and s2, or k + 1 if it is larger than k.
+
+    Only the diagonal band of width 2k + 1 is computed and the scan stops as
+    soon as every cell in a row exceeds k.
+    """
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    len1, len2 = len(s1), len(s2)
+    limit = k + 1
+    if len1 - len2 > k:
+        return limit
+    if len2 == 0:
+        return len1
+
+    previous_row = [j if j <= k else limit for j in range(len2 + 1)]
+    current_row = [limit] * (len2 + 1)
+    for i in range(1, len1 + 1):
+        c1 = s1[i - 1]
+        low = max(1, i - k)
+        high = min(len2, i + k)
+
+        current_row[0] = i if i <= k else limit
+        row_min = current_row[0]
+        if low > 1:
+            # Cell just left of the band is read by the first cell in it.
+            current_row[low - 1] = limit
+            row_min = limit
+        for j in range(low, high + 1):
+            value = previous_row[j - 1] + (c1 != s2[j - 1])
+            if previous_row[j] + 1 < value:
+                value = previous_row[j] + 1
+            if current_row[j - 1] + 1 < value:
+                value = current_row[j - 1] + 1
+            if value > limit:
+                value = limit
+            current_row[j] = value
+            if value < row_min:
+                row_min = value
+        if high < len2:
+            # Cell just right of the band is read by the next row.
+            current_row[high + 1] = limit
+
+        if row_min > k:
+            return limit
+        previous_row, current_row = current_row, previous_row
+
+    return min(previous_row[len2], limit)
+
+
+def within_distance(s1, s2, k=1):
+    """Returns True when the edit distance between s1 and s2 is at most k."""
+    if k == 1:
+        return _within_one(s1, s2)
+    return bounded_levenshtein(s1, s2, k) <= k
+
+
+def clean_within_distance(s1, s2, k=1):
+    """Same as within_distance, on normalized plate numbers."""
+    return within_distance(normalize_plate(s1), normalize_plate(s2), k)
+
+
+class PlateArray:
+    """Plates packed into a zero-padded code point matrix for batch comparisons.
+
+    Build it once for a list that is compared against repeatedly (for example
+    the registered plates) and pass it to batch_bounded_levenshtein.
+    """
+
+    def __init__(self, plates):
+        self.plates = list(plates)
+        np = _import_numpy()
+        if np is None:
+            return
+        self.lengths = np.fromiter((len(p) for p in self.plates), dtype=np.int64, count=len(self.plates))
+        width = int(self.lengths.max()) if len(self.plates) else 0
+        self.codes = np.zeros((len(self.plates), width), dtype=np.uint32)
+        for row, plate in enumerate(self.plates):
+            self.codes[row, :len(plate)] = np.frombuffer(plate.encode('utf-32-le'), dtype='<u4')
+
+    def __len__(self):
+        return len(self.plates)
+
+
+def batch_bounded_levenshtein(plate, plates, k):
+    """Returns the bounded edit distance from plate to each of plates.
+
+    plates may be a list of strings or a PlateArray. Distances larger than k
+    are reported as k + 1. With NumPy the result is an integer array computed
+    one query character at a time across all plates at once; without it the
+    result is a list.
+    """
+    if not isinstance(plates, PlateArray):
+        plates = PlateArray(plates)
+    np = _import_numpy()
+    if np is None:
+        return [bounded_levenshtein(plate, p, k) for p in plates.plates]
+
+    limit = k + 1
+    count = len(plates)
+    lengths = plates.lengths
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    if len(plate) == 0:
+        return np.minimum(lengths, limit)
+
+    codes = plates.codes
+    width = codes.shape[1]
+    query = np.frombuffer(plate.encode('utf-32-le'), dtype='<u4')
+    offsets = np.arange(width + 1, dtype=np.int64)
+
+    distances = np.full(count, limit, dtype=np.int64)
+    # Plates whose length differs by more than k can never be within k.
+    active = np.flatnonzero(np.abs(lengths - len(query)) <= k)
+    if len(active) == 0:
+        return distances
+    previous_row = np.broadcast_to(np.minimum(offsets, limit), (len(active), width + 1))
+    for i, code in enumerate(query, 1):
+        # Substitution and insertion only depend on the previous row ...
+        partial = np.empty((len(active), width + 1), dtype=np.int64)
+        partial[:, 0] = i
+        partial[:, 1:] = np.minimum(previous_row[:, :-1] + (codes[active] != code), previous_row[:, 1:] + 1)
+        # ... and deletions chain left to right: cell j is the minimum over t <= j of partial[t] + (j - t).
+        current_row = np.minimum.accumulate(partial - offsets, axis=1) + offsets
+        np.minimum(current_row, limit, out=current_row)
+
+        keep = current_row.min(axis=1) <= k
+        if not keep.all():
+            active = active[keep]
+            current_row = current_row[keep]
+            if len(active) == 0:
+                return distances
+        previous_row = current_row
+
+    distances[active] = previous_row[np.arange(len(active)), lengths[active]]
+    return distances
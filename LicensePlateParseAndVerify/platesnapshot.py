@@ -0,0 +1,260 @@
+"""Compiled, memory-mapped snapshot of the registered plates and camera roles.
+
+A snapshot is built once from the registered plate list and a camera role
+map and then memory-mapped by the verify step, so a container neither parses
+the list nor holds its own copy of it, however many plates there are. The
+file is laid out as:
+
+- a header: magic, format, plate count, snapshot version and the offset and
+  length of every section
+- the plates, in the order of the plate list with duplicates dropped, as an
+  offset table and a UTF-8 blob
+- three lookup tables of (64-bit token hash, plate number) pairs sorted by
+  hash, for the normalized plates, their canonical keys and their
+  single-character deletions; these are the same keys a PlateIndex keeps in
+  dicts, and a lookup is a binary search in the mapped arrays
+- the camera role map as JSON: site id -> camera label -> role, where the
+  role is 'entrance', 'valet' or 'exit'
+
+PlateSnapshot.find_any matches like PlateIndex.find_any, with the position
+in the plate list as the rank, so the same plate wins a tie as in a
+PlateIndex built from the list.
+
+Build a snapshot with:
+
+    python platesnapshot.py Registered_License_Plates.txt camera_roles.json registered_plates.snapshot
+
+The version defaults to the current Unix time; a loader only replaces its
+snapshot with one of a higher version.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+
+from metrics import metrics
+from platematching import (MAX_CONFUSED_CHARACTERS, canonical_plate, confused_characters, normalize_plate,
+                           within_distance)
+
+MAGIC = b'LPRSNAP\x00'
+FORMAT_VERSION = 1
+SECTIONS = ('plate_offsets', 'plate_data', 'exact_hashes', 'exact_ids', 'canonical_hashes', 'canonical_ids',
+            'neighbour_hashes', 'neighbour_ids', 'camera_roles')
+HEADER = struct.Struct('<8sHHIQ' + 'QQ' * len(SECTIONS))
+ROLES = ('entrance', 'valet', 'exit')
+
+
+def _token_hash(token):
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _deletions(key):
+    return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+
+def _lookup_table(tokens_by_plate):
+    pairs = sorted((_token_hash(token), plate_id) for plate_id, tokens in enumerate(tokens_by_plate) for token in tokens)
+    return array('Q', (h for h, _ in pairs)).tobytes(), array('I', (i for _, i in pairs)).tobytes()
+
+
+def build_snapshot(plates, camera_roles, version=None):
+    """Returns the bytes of a snapshot of plates and camera_roles (site id -> camera label -> role)."""
+    for site, cameras in camera_roles.items():
+        for camera_label, role in cameras.items():
+            if role not in ROLES:
+                raise ValueError(f"Camera '{camera_label}' of site {site} has unknown role '{role}'.")
+
+    # File order, so the earlier plate still wins a tie.
+    plates = list(dict.fromkeys(plate.strip() for plate in plates if plate.strip()))
+    keys = [normalize_plate(plate) for plate in plates]
+    encoded = [plate.encode('utf-8') for plate in plates]
+    offsets = array('I', [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+
+    sections = {
+        'plate_offsets': offsets.tobytes(),
+        'plate_data': b''.join(encoded),
+        'camera_roles': json.dumps(camera_roles, sort_keys=True).encode('utf-8'),
+    }
+    sections['exact_hashes'], sections['exact_ids'] = _lookup_table([key] for key in keys)
+    sections['canonical_hashes'], sections['canonical_ids'] = _lookup_table([canonical_plate(key)] for key in keys)
+    sections['neighbour_hashes'], sections['neighbour_ids'] = _lookup_table(_deletions(key) for key in keys)
+
+    body = bytearray()
+    layout = []
+    for name in SECTIONS:
+        # 8-byte alignment so the hash arrays can be mapped as 64-bit integers.
+        body.extend(b'\x00' * (-(HEADER.size + len(body)) % 8))
+        layout += [HEADER.size + len(body), len(sections[name])]
+        body.extend(sections[name])
+    if version is None:
+        version = int(time.time())
+    return HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(plates), version, *layout) + bytes(body)
+
+
+def write_snapshot(path, plates, camera_roles, version=None):
+    """Builds a snapshot into path, replacing it atomically."""
+    data = build_snapshot(plates, camera_roles, version)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
+def read_snapshot_version(path):
+    """Returns the version in the header of the snapshot at path."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    magic, format_version, _, _, version = HEADER.unpack(header)[:5]
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a format {FORMAT_VERSION} plate snapshot.")
+    return version
+
+
+class PlateSnapshot:
+    """Read-only plate lookups and camera roles over a memory-mapped snapshot."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        fields = HEADER.unpack_from(view)
+        magic, format_version, _, self._count, self.version = fields[:5]
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"Not a format {FORMAT_VERSION} plate snapshot.")
+        sections = {name: view[fields[5 + 2 * i]:fields[5 + 2 * i] + fields[6 + 2 * i]] for i, name in enumerate(SECTIONS)}
+
+        self._plate_offsets = sections['plate_offsets'].cast('I')
+        self._plate_data = sections['plate_data']
+        self._tables = {
+            name: (sections[f'{name}_hashes'].cast('Q'), sections[f'{name}_ids'].cast('I'))
+            for name in ('exact', 'canonical', 'neighbour')
+        }
+        self.camera_roles = json.loads(bytes(sections['camera_roles']).decode('utf-8'))
+        self._cameras = {
+            camera_label: (site, role)
+            for site, cameras in self.camera_roles.items()
+            for camera_label, role in cameras.items()
+        }
+
+    @classmethod
+    def open(cls, path):
+        """Memory-maps the snapshot at path."""
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self._count
+
+    def camera_role(self, camera_label):
+        """Returns (site id, role) of a camera, or (None, None) for an unknown camera."""
+        return self._cameras.get(camera_label, (None, None))
+
+    def cameras(self, site, role):
+        """Returns the labels of the cameras with role at site."""
+        return [label for label, camera_role in self.camera_roles.get(site, {}).items() if camera_role == role]
+
+    def plate(self, plate_id):
+        return bytes(self._plate_data[self._plate_offsets[plate_id]:self._plate_offsets[plate_id + 1]]).decode('utf-8')
+
+    def _ids(self, table, token):
+        hashes, ids = self._tables[table]
+        token_hash = _token_hash(token)
+        i = bisect_left(hashes, token_hash)
+        while i < len(hashes) and hashes[i] == token_hash:
+            yield ids[i]
+            i += 1
+
+    def _key(self, plate_id):
+        return normalize_plate(self.plate(plate_id))
+
+    def candidates(self, key):
+        """Returns the ids of the plates that may be within distance one of key."""
+        plate_ids = set(self._ids('exact', key)) | set(self._ids('neighbour', key))
+        for deletion in _deletions(key):
+            plate_ids.update(self._ids('exact', deletion))
+            plate_ids.update(self._ids('neighbour', deletion))
+        return plate_ids
+
+    def matches(self, plate):
+        """Yields (plate, rank) for every registered plate within distance one of plate."""
+        key = normalize_plate(plate)
+        plate_ids = self.candidates(key)
+        metrics.count('plate_comparisons', len(plate_ids))
+        for plate_id in plate_ids:
+            if within_distance(self._key(plate_id), key):
+                yield self.plate(plate_id), plate_id
+
+    def find(self, plate):
+        """Returns the first registered plate within distance one of plate, or None."""
+        best = min(self.matches(plate), key=lambda match: match[1], default=None)
+        return best[0] if best is not None else None
+
+    def find_any(self, plates, accept=None):
+        """Returns the registered plate best matching any of the candidate plates, or None.
+
+        Same rules as PlateIndex.find_any.
+        """
+        keys = []
+        for plate in plates:
+            key = normalize_plate(plate) if plate else ''
+            if key and key not in keys:
+                keys.append(key)
+        if not keys:
+            return None
+
+        best_value, best_order = None, None
+        for position, key in enumerate(keys):
+            # A canonical hash can collide, so the folded keys are compared too.
+            canonical = canonical_plate(key)
+            plate_ids = [plate_id for plate_id in self._ids('canonical', canonical)
+                         if canonical_plate(self._key(plate_id)) == canonical]
+            indexed_keys = {self._key(plate_id) for plate_id in plate_ids}
+            for plate_id in plate_ids:
+                indexed = self._key(plate_id)
+                if indexed == key:
+                    tier, distance = 0, 0
+                else:
+                    tier = 1
+                    distance = confused_characters(key, indexed)
+                    if distance > MAX_CONFUSED_CHARACTERS:
+                        continue
+                value = self.plate(plate_id)
+                order = (tier, position, distance, plate_id)
+                if (best_order is None or order < best_order) and (accept is None or accept(value)):
+                    best_value, best_order = value, order
+            if len(indexed_keys) > 1:
+                metrics.count('plate_comparisons', len(indexed_keys))
+        if best_order is not None:
+            return best_value
+
+        best_rank = None
+        for value, rank in self.matches(keys[0]):
+            if (best_rank is None or rank < best_rank) and (accept is None or accept(value)):
+                best_value, best_rank = value, rank
+        return best_value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds a registered plate snapshot.')
+    parser.add_argument('plates', help='text file with one registered plate per line')
+    parser.add_argument('camera_roles', help='JSON file mapping site id -> camera label -> role')
+    parser.add_argument('output', help='snapshot file to write')
+    parser.add_argument('--version', type=int, help='snapshot version, defaults to the current Unix time')
+    args = parser.parse_args()
+
+    with open(args.plates) as f:
+        plates = f.read().splitlines()
+    with open(args.camera_roles) as f:
+        camera_roles = json.load(f)
+    write_snapshot(args.output, plates, camera_roles, args.version)
+    print(f"Wrote {args.output} (version {read_snapshot_version(args.output)}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Write pipeline for parsed plate reads.
+
+PlateReadWriter uploads the plate and vehicle crops of each read through a
+bounded thread pool and writes the finished items to LprDataTable through
+boto3's batch_writer, which sends them 25 at a time and resends any
+unprocessed items. Reads are written in the order they were added. At most
+max_pending reads (and their decoded images) are held at once; adding one
+more waits for the oldest read's uploads and queues its item.
+
+Crops are stored under the SHA-256 of their bytes, so identical crops (a car
+idling in front of a camera, or a file parsed again after a retry) share one
+S3 object. A crop is uploaded at most once per invocation, and not at all if
+this container stored it recently. Otherwise it is written with
+If-None-Match: *, so S3 keeps the copy it already has and the write still
+counts as done.
+
+Every item has been written once the writer's with-block exits, so callers
+only announce the items after that.
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from metrics import metrics
+
+# Keys of the crops this container has stored, most recent last.
+STORED_IMAGE_CACHE_SIZE = int(os.environ.get('STORED_IMAGE_CACHE_SIZE', 8192))
+# A conditional write racing another write of the same key gets a 409 and can be retried.
+CONDITIONAL_PUT_ATTEMPTS = 3
+
+logger = logging.getLogger()
+
+_stored_images = OrderedDict()
+_stored_images_lock = threading.Lock()
+
+
+def _recently_stored(image_key):
+    with _stored_images_lock:
+        if image_key not in _stored_images:
+            return False
+        _stored_images.move_to_end(image_key)
+        return True
+
+
+def _remember_stored(image_key):
+    with _stored_images_lock:
+        _stored_images[image_key] = True
+        _stored_images.move_to_end(image_key)
+        while len(_stored_images) > STORED_IMAGE_CACHE_SIZE:
+            _stored_images.popitem(last=False)
+
+
+class PlateReadWriter:
+    """Concurrent crop uploads and batched item writes for one invocation."""
+
+    def __init__(self, s3, table, image_bucket_name, max_workers=16, max_pending=64):
+        self.s3 = s3
+        self.table = table
+        self.image_bucket_name = image_bucket_name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.keys = []
+        self._pending = deque()
+        # Pending entries by plate_read_id, so a rewrite of an unwritten item replaces it.
+        self._pending_by_id = {}
+        self._uploads = {}
+        self._executor = None
+        self._batch = None
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._batch = self.table.batch_writer(overwrite_by_pkeys=['plate_read_id', 'plate_read_timestamp'])
+        self._batch.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                while self._pending:
+                    self._write_oldest()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+            if exc_type is None:
+                # Flushes the last partial batch.
+                with metrics.timer('dynamodb_write'):
+                    self._batch.__exit__(None, None, None)
+        return False
+
+    def _image_url(self, image_key):
+        return f"https://{self.image_bucket_name}.s3.amazonaws.com/{image_key}"
+
+    def _upload(self, image_key, image_data):
+        for attempt in range(1, CONDITIONAL_PUT_ATTEMPTS + 1):
+            try:
+                with metrics.timer('image_upload'):
+                    self.s3.put_object(
+                        Bucket=self.image_bucket_name,
+                        Key=image_key,
+                        Body=image_data,
+                        ContentType='image/jpeg',
+                        IfNoneMatch='*'
+                    )
+                metrics.count('image_bytes_uploaded', len(image_data))
+                break
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in ('PreconditionFailed', '412'):
+                    # Stored before, by another container or an earlier attempt.
+                    metrics.count('images_already_stored')
+                    break
+                if code not in ('ConditionalRequestConflict', '409') or attempt == CONDITIONAL_PUT_ATTEMPTS:
+                    raise
+            finally:
+                metrics.count('s3_calls')
+        _remember_stored(image_key)
+        return self._image_url(image_key)
+
+    def _store_image(self, prefix, encoded_image, name):
+        """Returns a future for the URL of the crop, uploading it only if it may not be stored yet."""
+        try:
+            image_data = base64.b64decode(encoded_image)
+        except (base64.binascii.Error, TypeError) as e:
+            logger.error(f"Error decoding {name}: {e}")
+            return None
+
+        image_key = f"{prefix}/{hashlib.sha256(image_data).hexdigest()}.jpg"
+        upload = self._uploads.get(image_key)
+        if upload is not None:
+            metrics.count('images_deduplicated')
+            return upload
+
+        if _recently_stored(image_key):
+            metrics.count('images_deduplicated')
+            upload = Future()
+            upload.set_result(self._image_url(image_key))
+        else:
+            upload = self._executor.submit(self._upload, image_key, image_data)
+        self._uploads[image_key] = upload
+        return upload
+
+    def add(self, item, plate_crop_jpeg=None, vehicle_crop_jpeg=None, announce=True):
+        """Queues a read; its crops start uploading right away and the item is written once they finish.
+
+        The key of the item is only added to keys when announce is true, so
+        rewriting an item that was already announced does not repeat it. An
+        item whose plate_read_id is still waiting to be written replaces the
+        waiting one instead of being written twice.
+        """
+        uploads = {}
+        if plate_crop_jpeg:
+            uploads['plate_crop_jpeg_url'] = self._store_image('plate_images', plate_crop_jpeg, 'plate_crop_jpeg')
+        if vehicle_crop_jpeg:
+            uploads['vehicle_crop_jpeg_url'] = self._store_image('vehicle_images', vehicle_crop_jpeg, 'vehicle_crop_jpeg')
+
+        pending = self._pending_by_id.get(item['plate_read_id'])
+        if pending is not None:
+            pending[0] = item
+            # A crop the new item has no image for keeps the waiting item's upload.
+            pending[1] = {**pending[1], **uploads}
+            return
+        pending = [item, uploads, announce]
+        self._pending.append(pending)
+        self._pending_by_id[item['plate_read_id']] = pending
+
+        while len(self._pending) > self.max_pending:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        item, uploads, announce = self._pending.popleft()
+        del self._pending_by_id[item['plate_read_id']]
+        # Upload time that was not hidden behind parsing the following reads.
+        with metrics.timer('image_upload_wait'):
+            for field, upload in uploads.items():
+                item[field] = upload.result() if upload is not None else None
+
+        # Remove keys with None values before inserting into DynamoDB
+        item_to_insert = {k: v for k, v in item.items() if v is not None}
+        # batch_writer sends a BatchWriteItem request whenever 25 items are queued.
+        with metrics.timer('dynamodb_write'):
+            self._batch.put_item(Item=item_to_insert)
+        metrics.count('dynamodb_items_written')
+        if announce:
+            self.keys.append({
+                'plate_read_id': item_to_insert['plate_read_id'],
+                'plate_read_timestamp': item_to_insert.get('plate_read_timestamp')
+            })
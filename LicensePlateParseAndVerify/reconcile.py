@@ -0,0 +1,298 @@
+"""Offline valet revenue reconciliation.
+
+Replays the exit matching of the verify step over a date range and checks
+the revenue recorded on every valet ticket against the tariff:
+
+1. Valet tickets opened from --lookback-days before the range until its end
+   are read from an export or from ValetDataTable's DaysSinceEpochIndex.
+2. Exit reads over the same span, extended by --exit-grace-days after the
+   range, are read from an export or from LprDataTable's
+   DaysSinceEpochIndex. Exit cameras and their sites come from
+   camera_roles.json. Rows are partitioned by the day they were processed,
+   so both queries also read --processing-lag-days of later partitions.
+3. Exits are taken in time order and each is paired with the open ticket of
+   its site the verify step would have charged: the best match for its
+   candidate plates (PlateIndex.find_any, newest ticket first) among the
+   tickets opened within the 30 days before it. The lookback lets exits in
+   the range close tickets opened before it, and lets exits before the range
+   consume the tickets they closed.
+4. The charges of the pairs are computed in one vectorized tariff.charges
+   pass and compared with revenue_received.
+
+The report covers the tickets opened in the range and the pairs with a
+ticket or an exit in it: mispriced tickets, tickets no exit matched and exits
+in the range that matched no ticket, apart from those of registered plates.
+Exports are JSON arrays or JSON lines of plain items. For example:
+
+    python reconcile.py --start 2025-06-01 --end 2025-06-30 --valet-table ValetRevenueTracking --lpr-table LprDataTable
+    python reconcile.py --start 2025-06-01 --end 2025-06-30 --tickets tickets.jsonl --reads reads.jsonl --json report.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+
+import tariff
+from plateindex import PlateIndex
+from platematching import candidate_plates
+from platesnapshot import PlateSnapshot, build_snapshot
+from valettickets import DEFAULT_SITE, TICKET_WINDOW_MS
+
+logger = logging.getLogger()
+
+DAYS_SINCE_EPOCH_INDEX = 'DaysSinceEpochIndex'
+
+
+def _epoch_ms(day):
+    return int(datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc).timestamp() * 1000)
+
+
+def _plain(item):
+    """Turns the Decimals DynamoDB returns into ints and floats."""
+    return json.loads(json.dumps(item, default=lambda value: int(value) if value == int(value) else float(value)))
+
+
+def load_export(path):
+    """Returns the items of a JSON array or JSON lines export."""
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _partition_days(start_ms, end_ms, processing_lag_days):
+    """Returns the days_since_epoch partitions that may hold rows timestamped between start_ms and end_ms.
+
+    Rows are partitioned by the day they were processed, which can be up to
+    processing_lag_days after their timestamp.
+    """
+    return range(start_ms // tariff.MS_PER_DAY, (end_ms - 1) // tariff.MS_PER_DAY + processing_lag_days + 1)
+
+
+def _query_partitions(table, days, key_condition, **query_args):
+    """Returns the items of DaysSinceEpochIndex partitions, one query page at a time."""
+    items = []
+    for day in days:
+        query_args.pop('ExclusiveStartKey', None)
+        while True:
+            response = table.query(IndexName=DAYS_SINCE_EPOCH_INDEX, KeyConditionExpression=key_condition(day), **query_args)
+            items.extend(_plain(item) for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
+
+
+def query_tickets(table, start_ms, end_ms, processing_lag_days=1):
+    """Returns the valet tickets opened between start_ms and end_ms, one day partition at a time."""
+    return _query_partitions(
+        table,
+        _partition_days(start_ms, end_ms, processing_lag_days),
+        lambda day: Key('days_since_epoch').eq(day),
+        FilterExpression=Attr('plate_read_timestamp').between(start_ms, end_ms - 1),
+    )
+
+
+def query_reads(table, start_ms, end_ms, camera_labels, processing_lag_days=1):
+    """Returns the reads by camera_labels between start_ms and end_ms, one day partition at a time."""
+    if not camera_labels:
+        return []
+    return _query_partitions(
+        table,
+        _partition_days(start_ms, end_ms, processing_lag_days),
+        lambda day: Key('days_since_epoch').eq(day) & Key('plate_read_timestamp').between(start_ms, end_ms - 1),
+        FilterExpression=Attr('camera_label').is_in(list(camera_labels)),
+    )
+
+
+def pair_exits(tickets, exits, camera_sites):
+    """Pairs exits with the tickets they close, like the verify step.
+
+    camera_sites maps camera labels to site ids; an exit only closes tickets
+    of its camera's site. Tickets written before they recorded their site
+    belong to DEFAULT_SITE. Returns (pairs, unmatched exits), where pairs is
+    a list of (ticket, exit).
+    """
+    tickets = sorted(tickets, key=lambda ticket: ticket['plate_read_timestamp'])
+    exits = sorted(exits, key=lambda read: read['plate_read_timestamp'])
+    by_id = {}
+    # One index per site, so a plate can never close another site's ticket.
+    open_tickets = {}
+    pairs = []
+    unmatched = []
+    next_ticket = 0
+    for read in exits:
+        exit_timestamp = read['plate_read_timestamp']
+        while next_ticket < len(tickets) and tickets[next_ticket]['plate_read_timestamp'] <= exit_timestamp:
+            ticket = tickets[next_ticket]
+            by_id[ticket['plate_read_id']] = ticket
+            site_tickets = open_tickets.setdefault(ticket.get('site', DEFAULT_SITE), PlateIndex())
+            site_tickets.add(ticket.get('best_plate_number') or '', -ticket['plate_read_timestamp'], ticket['plate_read_id'])
+            next_ticket += 1
+
+        site_tickets = open_tickets.get(camera_sites.get(read.get('camera_label')))
+        plate_read_id = site_tickets.find_any(
+            candidate_plates(read),
+            accept=lambda plate_read_id: exit_timestamp - by_id[plate_read_id]['plate_read_timestamp'] <= TICKET_WINDOW_MS
+        ) if site_tickets is not None else None
+        if plate_read_id is None:
+            unmatched.append(read)
+            continue
+        ticket = by_id[plate_read_id]
+        site_tickets.remove(ticket.get('best_plate_number') or '', plate_read_id)
+        pairs.append((ticket, read))
+    return pairs, unmatched
+
+
+def reconcile(tickets, exits, start_ms, end_ms, camera_sites, registered=None):
+    """Returns the reconciliation report for the range from start_ms to end_ms.
+
+    tickets and exits may start before the range, so that earlier exits close
+    earlier tickets; only tickets opened in the range and pairs with a ticket
+    or an exit in it are reported. Exits for which registered(read) is true
+    are not reported as unmatched.
+    """
+    def in_range(item):
+        return start_ms <= item['plate_read_timestamp'] < end_ms
+
+    pairs, unmatched_exits = pair_exits(tickets, exits, camera_sites)
+    pairs = [(ticket, read) for ticket, read in pairs if in_range(ticket) or in_range(read)]
+    tickets = [ticket for ticket in tickets if in_range(ticket)]
+    expected = tariff.charges([ticket['plate_read_timestamp'] for ticket, _ in pairs],
+                              [read['plate_read_timestamp'] for _, read in pairs])
+
+    mispriced = []
+    expected_revenue = 0
+    received_revenue = 0
+    paired_ids = set()
+    for (ticket, read), expected_charge in zip(pairs, expected):
+        expected_charge = int(expected_charge)
+        received = ticket.get('revenue_received') or 0
+        paired_ids.add(ticket['plate_read_id'])
+        expected_revenue += expected_charge
+        received_revenue += received
+        if received != expected_charge:
+            mispriced.append({
+                'plate_read_id': ticket['plate_read_id'],
+                'best_plate_number': ticket.get('best_plate_number'),
+                'entry_timestamp': ticket['plate_read_timestamp'],
+                'exit_plate_read_id': read.get('plate_read_id'),
+                'exit_plate_number': read.get('best_plate_number'),
+                'exit_timestamp': read['plate_read_timestamp'],
+                'expected': expected_charge,
+                'received': received,
+            })
+
+    unmatched_tickets = [
+        {
+            'plate_read_id': ticket['plate_read_id'],
+            'best_plate_number': ticket.get('best_plate_number'),
+            'entry_timestamp': ticket['plate_read_timestamp'],
+            'received': ticket.get('revenue_received') or 0,
+        }
+        for ticket in tickets if ticket['plate_read_id'] not in paired_ids
+    ]
+    received_revenue += sum(ticket['received'] for ticket in unmatched_tickets)
+    unmatched_exits = [
+        {
+            'plate_read_id': read.get('plate_read_id'),
+            'best_plate_number': read.get('best_plate_number'),
+            'camera_label': read.get('camera_label'),
+            'exit_timestamp': read['plate_read_timestamp'],
+        }
+        for read in unmatched_exits
+        if in_range(read) and not (registered and registered(read))
+    ]
+    return {
+        'tickets': len(tickets),
+        'exits': len(exits),
+        'paired': len(pairs),
+        'expected_revenue': expected_revenue,
+        'received_revenue': received_revenue,
+        'mispriced': mispriced,
+        'unmatched_tickets': unmatched_tickets,
+        'unmatched_exits': unmatched_exits,
+    }
+
+
+def load_snapshot(args):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    if args.snapshot:
+        return PlateSnapshot.open(args.snapshot)
+    with open(os.path.join(script_dir, 'Registered_License_Plates.txt')) as f:
+        plates = f.read().splitlines()
+    with open(os.path.join(script_dir, 'camera_roles.json')) as f:
+        camera_roles = json.load(f)
+    return PlateSnapshot(build_snapshot(plates, camera_roles))
+
+
+def report(results):
+    print(f"tickets {results['tickets']}  exits {results['exits']}  paired {results['paired']}")
+    print(f"expected revenue {results['expected_revenue']}  received revenue {results['received_revenue']}")
+    print(f"mispriced {len(results['mispriced'])}  unmatched tickets {len(results['unmatched_tickets'])}  "
+          f"unmatched exits {len(results['unmatched_exits'])}")
+    for ticket in results['mispriced']:
+        print(f"  mispriced {ticket['plate_read_id']} {ticket['best_plate_number']}: "
+              f"expected {ticket['expected']}, received {ticket['received']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat, help='first day, YYYY-MM-DD (UTC)')
+    parser.add_argument('--end', required=True, type=datetime.date.fromisoformat, help='last day, YYYY-MM-DD (UTC)')
+    parser.add_argument('--tickets', help='valet ticket export, instead of querying --valet-table')
+    parser.add_argument('--reads', help='plate read export, instead of querying --lpr-table')
+    parser.add_argument('--valet-table', default=os.environ.get('VALET_DYNAMODB_TABLE', 'ValetRevenueTracking'))
+    parser.add_argument('--lpr-table', default=os.environ.get('LPR_DYNAMODB_TABLE'))
+    parser.add_argument('--exit-grace-days', type=int, default=1,
+                        help='days after --end whose exits may still close tickets of the range')
+    parser.add_argument('--lookback-days', type=int, default=TICKET_WINDOW_MS // tariff.MS_PER_DAY,
+                        help='days before --start whose tickets may still be closed by exits in the range')
+    parser.add_argument('--processing-lag-days', type=int, default=1,
+                        help='days after its timestamp a read or ticket may have been processed, and so partitioned')
+    parser.add_argument('--snapshot', help='registered plate snapshot, instead of the bundled plate list and camera roles')
+    parser.add_argument('--json', help='also write the full report to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    start_ms = _epoch_ms(args.start)
+    end_ms = _epoch_ms(args.end + datetime.timedelta(days=1))
+    exits_end_ms = end_ms + args.exit_grace_days * tariff.MS_PER_DAY
+    lookback_start_ms = start_ms - args.lookback_days * tariff.MS_PER_DAY
+
+    snapshot = load_snapshot(args)
+    camera_sites = {label: site for site in snapshot.camera_roles for label in snapshot.cameras(site, 'exit')}
+
+    if args.tickets:
+        tickets = [ticket for ticket in load_export(args.tickets)
+                   if lookback_start_ms <= ticket['plate_read_timestamp'] < end_ms]
+    else:
+        tickets = query_tickets(boto3.resource('dynamodb').Table(args.valet_table), lookback_start_ms, end_ms,
+                                args.processing_lag_days)
+
+    if args.reads:
+        exits = [read for read in load_export(args.reads)
+                 if read.get('camera_label') in camera_sites and lookback_start_ms <= read['plate_read_timestamp'] < exits_end_ms]
+    elif args.lpr_table:
+        exits = query_reads(boto3.resource('dynamodb').Table(args.lpr_table), lookback_start_ms, exits_end_ms,
+                            camera_sites, args.processing_lag_days)
+    else:
+        parser.error('--reads or --lpr-table is required')
+    logger.info(f"Loaded {len(tickets)} tickets and {len(exits)} exits.")
+
+    results = reconcile(tickets, exits, start_ms, end_ms, camera_sites,
+                        registered=lambda read: snapshot.find_any(candidate_plates(read)) is not None)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Valet parking tariff.
+
+A stay longer than 24 hours pays DAY_RATE for every full day, and what is
+left of it pays the first band it fits in: up to 2 hours 15, up to 8 hours
+20, up to 12 hours 24 and up to 24 hours 36. A stay of exactly 24 hours is a
+single 36 band.
+
+charge prices one exit, as the verify step does. charges prices whole arrays
+of entry and exit timestamps in one vectorized pass for offline
+reconciliation; it needs NumPy, and falls back to charge per stay without
+it. Both work in integer milliseconds, so they always agree.
+"""
+MS_PER_HOUR = 60 * 60 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+DAY_RATE = 36
+# (longest stay in the band, price), shortest first.
+BANDS = ((2 * MS_PER_HOUR, 15), (8 * MS_PER_HOUR, 20), (12 * MS_PER_HOUR, 24), (24 * MS_PER_HOUR, 36))
+
+_numpy = None
+
+
+def _import_numpy():
+    """Imports NumPy on first use, since the handlers never need it; returns None if it is missing."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:  # NumPy is optional; charges falls back to charge.
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def charge(entry_timestamp, exit_timestamp):
+    """Returns the charge for a stay from entry_timestamp to exit_timestamp, both in epoch milliseconds."""
+    duration_ms = int(exit_timestamp) - int(entry_timestamp)
+    total = 0
+    if duration_ms > MS_PER_DAY:
+        total = duration_ms // MS_PER_DAY * DAY_RATE
+        duration_ms %= MS_PER_DAY
+    for longest_ms, price in BANDS:
+        if duration_ms <= longest_ms:
+            return total + price
+    return total
+
+
+def charges(entry_timestamps, exit_timestamps):
+    """Returns the charges for the stays between matching entry and exit timestamps.
+
+    The result is an int64 NumPy array, or a list when NumPy is not installed.
+    """
+    np = _import_numpy()
+    if np is None:
+        return [charge(entry, exit) for entry, exit in zip(entry_timestamps, exit_timestamps)]
+
+    durations = np.asarray(exit_timestamps, dtype=np.int64) - np.asarray(entry_timestamps, dtype=np.int64)
+    multi_day = durations > MS_PER_DAY
+    totals = np.where(multi_day, durations // MS_PER_DAY * DAY_RATE, 0)
+    remainders = np.where(multi_day, durations % MS_PER_DAY, durations)
+    # Index of the first band whose longest stay is at least the remainder; never past the 24 hour band.
+    band = np.searchsorted(np.array([longest_ms for longest_ms, _ in BANDS], dtype=np.int64), remainders, side='left')
+    prices = np.array([price for _, price in BANDS], dtype=np.int64)
+    return totals + prices[band]
@@ -0,0 +1,192 @@
+"""Sliding-window cache of recent plate sightings from LprDataTable.
+
+The unregistered-entrance check asks whether a plate was seen at the valet
+camera in the ten minutes before the entrance read. Reads close together in
+time ask for nearly the same window, so SightingsCache remembers which
+timestamp ranges of each DaysSinceEpochIndex partition it already holds, as
+a sorted list of disjoint intervals, and only queries the parts of a new
+window it has not fetched yet. Sightings are
+indexed by camera label and normalized plate, and evicted by timestamp once
+they fall well behind the newest window asked for.
+
+Rows for reads in an earlier Firehose file can still be arriving when a
+window is fetched, so between invocations the most recent SETTLE_MS fetched
+of every partition is treated as unfetched and queried again. Rows can land later
+than that too (a Firehose retry, a slow parse), so a lookup that finds no
+match in the cache queries its window directly before giving up, like the
+verify step did before the cache existed. Only the misses, mostly
+unregistered vehicles that did not use the valet, pay for that query.
+
+The verify step loads the windows of a whole batch with one call to load()
+before its worker threads look sightings up. The cache is guarded by a lock
+that is never held during a DynamoDB query.
+"""
+import os
+import threading
+
+from boto3.dynamodb.conditions import Key
+
+from metrics import metrics
+from plateindex import PlateIndex
+
+WINDOW_MS = 10 * 60 * 1000
+# Defaults to the Firehose buffering interval.
+SETTLE_MS = int(os.environ.get('VALET_SIGHTINGS_SETTLE_MS', 5 * 60 * 1000))
+
+
+class SightingsCache:
+    """Recent LprDataTable rows, indexed by camera and plate."""
+
+    def __init__(self, table, window_ms=WINDOW_MS, settle_ms=SETTLE_MS):
+        self.table = table
+        self.window_ms = window_ms
+        self.settle_ms = settle_ms
+        self._fetched = {}
+        self._items = {}
+        self._cameras = {}
+        self._newest = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def new_batch(self):
+        """Marks the start of an invocation: evicts old sightings and reopens the unsettled tail."""
+        with self._lock:
+            if self._newest is not None:
+                self._evict(self._newest - 2 * self.window_ms)
+            for day, intervals in list(self._fetched.items()):
+                self._fetched[day] = self._clip(intervals, None, intervals[-1][1] - self.settle_ms)
+                if not self._fetched[day]:
+                    del self._fetched[day]
+
+    def _add(self, item):
+        plate_read_id = item['plate_read_id']
+        if plate_read_id in self._items:
+            return
+        self._items[plate_read_id] = item
+        index = self._cameras.get(item.get('camera_label'))
+        if index is None:
+            index = self._cameras[item.get('camera_label')] = PlateIndex()
+        # Most recent sighting first.
+        index.add(item.get('best_plate_number') or '', -item['plate_read_timestamp'], plate_read_id)
+
+    def _evict(self, cutoff):
+        for item in [i for i in self._items.values() if i['plate_read_timestamp'] < cutoff]:
+            del self._items[item['plate_read_id']]
+            self._cameras[item.get('camera_label')].remove(item.get('best_plate_number') or '', item['plate_read_id'])
+        for day, intervals in list(self._fetched.items()):
+            self._fetched[day] = self._clip(intervals, cutoff, None)
+            if not self._fetched[day]:
+                del self._fetched[day]
+
+    @staticmethod
+    def _clip(intervals, low, high):
+        """Returns the parts of the sorted, disjoint intervals between low and high (None for unbounded)."""
+        clipped = []
+        for start, end in intervals:
+            if low is not None:
+                start = max(start, low)
+            if high is not None:
+                end = min(end, high)
+            if start <= end:
+                clipped.append([start, end])
+        return clipped
+
+    def _query(self, day, start, end):
+        """Returns the rows of partition day with a timestamp in [start, end]."""
+        items = []
+        query_args = {
+            'IndexName': 'DaysSinceEpochIndex',
+            'KeyConditionExpression': Key('days_since_epoch').eq(day) & Key('plate_read_timestamp').between(start, end),
+        }
+        while True:
+            with metrics.timer('dynamodb_read'):
+                response = self.table.query(**query_args)
+            metrics.count('dynamodb_calls')
+            metrics.count('dynamodb_items_scanned', response.get('ScannedCount', len(response.get('Items', []))))
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return items
+
+    def _missing(self, day, start, end):
+        """Returns the parts of [start, end] of partition day that are not cached yet."""
+        missing = []
+        covered = False
+        for low, high in self._fetched.get(day, ()):
+            if high < start:
+                continue
+            if low > end:
+                break
+            if low > start:
+                missing.append((start, low))
+            start = max(start, high)
+            covered = True
+        if start < end or not covered:
+            missing.append((start, end))
+        return missing
+
+    def _fetched_range(self, day, start, end):
+        """Records that every row of partition day with a timestamp in [start, end] is cached."""
+        merged = []
+        for low, high in self._fetched.get(day, ()):
+            if high < start or low > end:
+                merged.append([low, high])
+            else:
+                start = min(start, low)
+                end = max(end, high)
+        merged.append([start, end])
+        self._fetched[day] = sorted(merged)
+
+    def load(self, days, start, end):
+        """Caches every sighting in the given partitions with a timestamp in [start, end]."""
+        with self._lock:
+            if self._newest is None or end > self._newest:
+                self._newest = end
+            missing = [(day, self._missing(day, start, end)) for day in days]
+
+        # Queried without the lock, so the other worker threads keep using the cache meanwhile.
+        fetched = [(day, [self._query(day, low, high) for low, high in ranges]) for day, ranges in missing if ranges]
+
+        with self._lock:
+            for day, results in fetched:
+                for items in results:
+                    for item in items:
+                        self._add(item)
+                self._fetched_range(day, start, end)
+
+    def find(self, camera_label, plates, days, start, end):
+        """Returns the sighting at camera_label that best matches the candidate plates of a read.
+
+        Only sightings with a timestamp in [start, end] in the given
+        DaysSinceEpochIndex partitions count. See PlateIndex.find_any for how
+        the candidates are matched; between equally good matches the most
+        recent sighting wins.
+        """
+        def in_window(plate_read_id):
+            item = self._items[plate_read_id]
+            return item['days_since_epoch'] in days and start <= item['plate_read_timestamp'] <= end
+
+        self.load(days, start, end)
+        sighting = self._find(camera_label, plates, in_window)
+        if sighting is not None:
+            return sighting
+
+        # Rows can land after their range was cached, so a miss is checked against the table.
+        metrics.count('sightings_cache_misses')
+        fetched = [item for day in days for item in self._query(day, start, end)]
+        with self._lock:
+            for item in fetched:
+                self._add(item)
+        return self._find(camera_label, plates, in_window)
+
+    def _find(self, camera_label, plates, accept):
+        with self._lock:
+            index = self._cameras.get(camera_label)
+            if index is None:
+                return None
+            with metrics.timer('fuzzy_match'):
+                plate_read_id = index.find_any(plates, accept=accept)
+            return self._items[plate_read_id] if plate_read_id is not None else None
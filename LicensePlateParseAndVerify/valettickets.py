@@ -0,0 +1,252 @@
+"""Open valet ticket lookup for garage exits.
+
+A valet ticket is open while its ValetDataTable row carries the
+open_ticket_site attribute. The attribute is written together with the row
+at the entrance and removed in the same update that records the revenue, so
+the sparse OpenTicketIndex (open_ticket_site, plate_read_timestamp) only ever
+holds unpaid tickets. The site attribute is written alongside it and kept,
+so reconciliation can tell the sites of paid tickets apart.
+
+OpenTicketCache keeps those tickets in memory for the life of the container,
+keyed on the normalized plate through a PlateIndex. Each refresh only asks
+the index for tickets newer than the last one it has seen, so an exit costs
+at most one query plus the conditional update that closes the ticket. Tickets
+this container opens are added to the cache straight away, since the index
+is only eventually consistent. The cache is shared by the verify worker
+threads and guarded by a lock.
+
+Closing a ticket also marks the exit read in LprDataTable with the ticket it
+paid for, in the same transaction, so a redelivered exit can never charge a
+second ticket.
+
+Run this module directly to backfill open_ticket_site on unpaid tickets that
+were written before the index existed:
+
+    python valettickets.py ValetRevenueTracking
+"""
+import logging
+import sys
+import threading
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+
+from metrics import metrics
+from plateindex import PlateIndex
+
+OPEN_TICKET_INDEX = 'OpenTicketIndex'
+DEFAULT_SITE = '900'
+
+# Tickets older than this are never matched, same as the old 30 day scan.
+TICKET_WINDOW_MS = 30 * 24 * 60 * 60 * 1000
+# Tickets can be written a while after their entrance read (Firehose buffering
+# plus the SQS delay), so each incremental refresh re-reads this much history.
+REFRESH_OVERLAP_MS = 15 * 60 * 1000
+# Reload everything now and then to drop tickets closed by other containers.
+FULL_REFRESH_SECONDS = 15 * 60
+# Exits handled within this long of a refresh reuse it rather than querying again.
+MIN_REFRESH_INTERVAL_SECONDS = 1
+
+# What close() did.
+CLOSED = 'closed'
+TICKET_ALREADY_CLOSED = 'ticket_already_closed'
+EXIT_ALREADY_CHARGED = 'exit_already_charged'
+
+logger = logging.getLogger()
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class OpenTicketCache:
+    """In-process view of the open valet tickets for one site."""
+
+    def __init__(self, table, exit_table, site=DEFAULT_SITE):
+        self.table = table
+        self.exit_table = exit_table
+        self.site = site
+        self._tickets = {}
+        self._plates = PlateIndex()
+        self._newest_timestamp = None
+        self._loaded_at = None
+        self._refreshed_at = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def _add(self, ticket):
+        plate_read_id = ticket['plate_read_id']
+        if plate_read_id in self._tickets:
+            return
+        self._tickets[plate_read_id] = ticket
+        # Newest ticket first, like the old day-by-day scan from today backwards.
+        self._plates.add(ticket.get('best_plate_number') or '', -ticket['plate_read_timestamp'], plate_read_id)
+
+    def discard(self, ticket):
+        """Forgets a ticket, for example once it has been closed."""
+        with self._lock:
+            ticket = self._tickets.pop(ticket['plate_read_id'], None)
+            if ticket is not None:
+                self._plates.remove(ticket.get('best_plate_number') or '', ticket['plate_read_id'])
+
+    def refresh(self):
+        """Fetches tickets opened since the last refresh, or all of them when a full reload is due."""
+        with self._lock:
+            if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < MIN_REFRESH_INTERVAL_SECONDS:
+                return
+            self._refresh()
+            self._refreshed_at = time.monotonic()
+
+    def _refresh(self):
+        now_ms = _now_ms()
+        cutoff = now_ms - TICKET_WINDOW_MS
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > FULL_REFRESH_SECONDS:
+            self._tickets = {}
+            self._plates = PlateIndex()
+            self._newest_timestamp = None
+            self._loaded_at = time.monotonic()
+        else:
+            for ticket in [t for t in self._tickets.values() if t['plate_read_timestamp'] < cutoff]:
+                self.discard(ticket)
+
+        start = cutoff
+        if self._newest_timestamp is not None:
+            start = max(cutoff, self._newest_timestamp - REFRESH_OVERLAP_MS)
+
+        query_args = {
+            'IndexName': OPEN_TICKET_INDEX,
+            'KeyConditionExpression': Key('open_ticket_site').eq(self.site) & Key('plate_read_timestamp').gte(start),
+        }
+        while True:
+            with metrics.timer('dynamodb_read'):
+                response = self.table.query(**query_args)
+            metrics.count('dynamodb_calls')
+            metrics.count('dynamodb_items_scanned', response.get('ScannedCount', len(response.get('Items', []))))
+            for ticket in response.get('Items', []):
+                self._add(ticket)
+                if self._newest_timestamp is None or ticket['plate_read_timestamp'] > self._newest_timestamp:
+                    self._newest_timestamp = ticket['plate_read_timestamp']
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def find(self, plates):
+        """Returns the open ticket that best matches the candidate plates of an exit read, or None.
+
+        See PlateIndex.find_any for how the candidates are matched; between
+        equally good matches the newest ticket wins.
+        """
+        self.refresh()
+        with self._lock, metrics.timer('fuzzy_match'):
+            plate_read_id = self._plates.find_any(plates)
+            return self._tickets[plate_read_id] if plate_read_id is not None else None
+
+    def open(self, ticket):
+        """Writes a new ticket as open and caches it.
+
+        Returns False when a ticket with the same key already exists, for
+        example because the entrance read was verified before.
+        """
+        ticket = dict(ticket, site=self.site, open_ticket_site=self.site)
+        metrics.count('dynamodb_calls')
+        try:
+            with metrics.timer('dynamodb_write'):
+                self.table.put_item(
+                    Item=ticket,
+                    ConditionExpression=Attr('plate_read_id').not_exists()
+                )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        with self._lock:
+            self._add(ticket)
+        return True
+
+    def close(self, ticket, charge, exit_key):
+        """Records the charge on a ticket for the exit read with exit_key and removes it from the open ticket index.
+
+        Returns CLOSED, TICKET_ALREADY_CLOSED when another exit closed the
+        ticket first, or EXIT_ALREADY_CHARGED when this exit already paid for
+        a ticket. The ticket is only dropped from the cache once it is known
+        to be closed; if the write fails it stays cached, so a retried exit
+        still finds it.
+        """
+        client = self.table.meta.client
+        metrics.count('dynamodb_calls')
+        try:
+            with metrics.timer('dynamodb_write'):
+                client.transact_write_items(TransactItems=[
+                    {
+                        'Update': {
+                            'TableName': self.exit_table.name,
+                            'Key': exit_key,
+                            'UpdateExpression': "set charged_ticket_id = :t",
+                            'ConditionExpression': "attribute_exists(plate_read_id) AND attribute_not_exists(charged_ticket_id)",
+                            'ExpressionAttributeValues': {':t': ticket.get('plate_read_id')},
+                        }
+                    },
+                    {
+                        'Update': {
+                            'TableName': self.table.name,
+                            'Key': {
+                                'plate_read_id': ticket.get('plate_read_id'),
+                                'plate_read_timestamp': ticket.get('plate_read_timestamp')
+                            },
+                            'UpdateExpression': "set revenue_received = :r REMOVE open_ticket_site",
+                            'ConditionExpression': "attribute_exists(open_ticket_site)",
+                            'ExpressionAttributeValues': {':r': int(charge)},
+                        }
+                    },
+                ])
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            ticket_closed = reasons[1:2] == ['ConditionalCheckFailed']
+            if ticket_closed:
+                self.discard(ticket)
+            if reasons[:1] == ['ConditionalCheckFailed']:
+                # The ticket stays cached unless it is closed too, so its own exit still finds it.
+                return EXIT_ALREADY_CHARGED
+            if ticket_closed:
+                return TICKET_ALREADY_CLOSED
+            # Throttling or a TransactionConflict with another writer: the ticket is still open.
+            raise
+        self.discard(ticket)
+        return CLOSED
+
+
+def backfill_open_tickets(table, site=DEFAULT_SITE):
+    """Marks unpaid tickets from the last 30 days as open so OpenTicketIndex can find them."""
+    cutoff = _now_ms() - TICKET_WINDOW_MS
+    scan_args = {
+        'FilterExpression': Attr('revenue_received').eq(0)
+            & Attr('plate_read_timestamp').gte(cutoff)
+            & Attr('open_ticket_site').not_exists(),
+    }
+    updated = 0
+    while True:
+        response = table.scan(**scan_args)
+        for ticket in response.get('Items', []):
+            table.update_item(
+                Key={
+                    'plate_read_id': ticket['plate_read_id'],
+                    'plate_read_timestamp': ticket['plate_read_timestamp']
+                },
+                UpdateExpression="set open_ticket_site = :s",
+                ExpressionAttributeValues={
+                    ':s': site
+                }
+            )
+            updated += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return updated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    table_name = sys.argv[1] if len(sys.argv) > 1 else 'ValetRevenueTracking'
+    count = backfill_open_tickets(boto3.resource('dynamodb').Table(table_name))
+    logger.info(f"Marked {count} unpaid tickets as open.")
@@ -1,17 +1,53 @@
 import json
 import logging
 import os
-import boto3
 import datetime
+import decimal
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import BotoCoreError, ClientError
+
+import awsclients
+from metrics import instrumented, metrics
+from plategroups import group_related, plate_tokens
+from platematching import candidate_plates
+from platesnapshot import PlateSnapshot, read_snapshot_version
+import tariff
+from valetsightings import SightingsCache
+from valettickets import CLOSED, EXIT_ALREADY_CHARGED, OpenTicketCache
 
-dynamodb = boto3.resource('dynamodb')
-lpr_table = dynamodb.Table(os.environ['LPR_DYNAMODB_TABLE'])
-valet_table = dynamodb.Table(os.environ['VALET_DYNAMODB_TABLE'])
-registered_plate_tracker_table = dynamodb.Table(os.environ['REGISTERED_PLATE_TRACKER_TABLE'])
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+BATCH_GET_ITEM_LIMIT = 100
+BATCH_GET_ITEM_MAX_RETRIES = 8
+
+# Reads of unrelated plates are verified on this many threads; 1 verifies them one by one.
+VERIFY_CONCURRENCY = int(os.environ.get('VERIFY_CONCURRENCY', 8))
+
+# The registered plate snapshot is built at deploy time: it is packaged as PLATE_SNAPSHOT_PATH and
+# published to PLATE_SNAPSHOT_URI (s3://bucket/key). The published one is preferred, and a newer
+# version is picked up without a redeploy; the source is checked at most every
+# PLATE_SNAPSHOT_CHECK_SECONDS. Without either, plate reads fail rather than go unverified.
+PLATE_SNAPSHOT_URI = os.environ.get('PLATE_SNAPSHOT_URI')
+PLATE_SNAPSHOT_PATH = os.environ.get('PLATE_SNAPSHOT_PATH', os.path.join(os.path.dirname(__file__), 'registered_plates.snapshot'))
+PLATE_SNAPSHOT_CHECK_SECONDS = int(os.environ.get('PLATE_SNAPSHOT_CHECK_SECONDS', 60))
+DOWNLOADED_SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), 'registered_plates.snapshot')
+
+# Built on first use and kept for the life of the container.
+_plate_snapshot = None
+_plate_snapshot_checked_at = None
+_plate_snapshot_etag = None
+_open_ticket_caches = {}
+_sightings_cache = None
+# Kept for the life of the container, so each worker thread's boto3 resources are reused.
+_verify_executor = None
+_lock = threading.Lock()
+
 def getDaysSinceEpoch():
     """Calculates the number of full days since the Unix epoch (1970-01-01) in UTC."""
     # Get the current time as a timezone-aware object in UTC
@@ -25,231 +61,419 @@ def getDaysSinceEpoch():
     
     return days_since_epoch
 
-def clean_levenshtein(s1, s2):
-    s1 = s1.lower().replace('-', '').replace(' ', '')
-    s2 = s2.lower().replace('-', '').replace(' ', '')
-    return levenshtein(s1, s2)
+def getPlateSnapshotPath():
+    """Returns the local path of the newest registered plate snapshot available."""
+    global _plate_snapshot_etag
+    if PLATE_SNAPSHOT_URI:
+        bucket, _, key = PLATE_SNAPSHOT_URI[len('s3://'):].partition('/')
+        request = {'Bucket': bucket, 'Key': key}
+        if _plate_snapshot_etag and os.path.exists(DOWNLOADED_SNAPSHOT_PATH):
+            request['IfNoneMatch'] = _plate_snapshot_etag
+        try:
+            response = awsclients.client('s3').get_object(**request)
+        except (ClientError, BotoCoreError) as e:
+            if isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                return DOWNLOADED_SNAPSHOT_PATH
+            # Not published yet (S3 answers AccessDenied rather than NoSuchKey without s3:ListBucket)
+            # or S3 is unavailable. A loaded snapshot is kept; otherwise the packaged one is used.
+            if _plate_snapshot is not None or not os.path.exists(PLATE_SNAPSHOT_PATH):
+                raise
+            logger.warning(f"Could not fetch the plate snapshot at {PLATE_SNAPSHOT_URI}, using the packaged one: {e}")
+        else:
+            # Replaced rather than overwritten, so a snapshot that is still mapped stays intact.
+            temporary_path = f"{DOWNLOADED_SNAPSHOT_PATH}.tmp"
+            with open(temporary_path, 'wb') as f:
+                shutil.copyfileobj(response['Body'], f)
+            os.replace(temporary_path, DOWNLOADED_SNAPSHOT_PATH)
+            _plate_snapshot_etag = response.get('ETag')
+            return DOWNLOADED_SNAPSHOT_PATH
+
+    if not os.path.exists(PLATE_SNAPSHOT_PATH):
+        raise FileNotFoundError(f"No registered plate snapshot at {PLATE_SNAPSHOT_PATH}; build one with platesnapshot.py.")
+    return PLATE_SNAPSHOT_PATH
+
+def getPlateSnapshot():
+    """Returns the registered plate snapshot, switching to a newer version when one is published."""
+    global _plate_snapshot, _plate_snapshot_checked_at
+    if _plate_snapshot is not None and time.monotonic() - _plate_snapshot_checked_at < PLATE_SNAPSHOT_CHECK_SECONDS:
+        return _plate_snapshot
+    with _lock:
+        if _plate_snapshot is not None and time.monotonic() - _plate_snapshot_checked_at < PLATE_SNAPSHOT_CHECK_SECONDS:
+            return _plate_snapshot
+        try:
+            path = getPlateSnapshotPath()
+            if _plate_snapshot is None or read_snapshot_version(path) > _plate_snapshot.version:
+                # Readers still holding the previous snapshot keep using it until they are done.
+                _plate_snapshot = PlateSnapshot.open(path)
+                logger.info(f"Loaded plate snapshot version {_plate_snapshot.version} with {len(_plate_snapshot)} registered plates.")
+        except Exception as e:
+            if _plate_snapshot is None:
+                raise
+            logger.error(f"Failed to check for a newer plate snapshot, keeping version {_plate_snapshot.version}: {e}")
+        _plate_snapshot_checked_at = time.monotonic()
+    return _plate_snapshot
+
+def getOpenTicketCache(site):
+    """Returns the open valet ticket cache of a site, creating it on first use."""
+    cache = _open_ticket_caches.get(site)
+    if cache is None:
+        with _lock:
+            cache = _open_ticket_caches.get(site)
+            if cache is None:
+                cache = _open_ticket_caches[site] = OpenTicketCache(
+                    awsclients.ThreadLocalTable('VALET_DYNAMODB_TABLE'),
+                    awsclients.ThreadLocalTable('LPR_DYNAMODB_TABLE'),
+                    site
+                )
+    return cache
+
+def getVerifyExecutor():
+    """Returns the worker threads that verify groups of reads concurrently, creating them on first use."""
+    global _verify_executor
+    if _verify_executor is None:
+        with _lock:
+            if _verify_executor is None:
+                _verify_executor = ThreadPoolExecutor(max_workers=VERIFY_CONCURRENCY)
+    return _verify_executor
+
+def getSightingsCache():
+    """Returns the recent plate sightings cache, creating it on first use."""
+    global _sightings_cache
+    if _sightings_cache is None:
+        _sightings_cache = SightingsCache(awsclients.ThreadLocalTable('LPR_DYNAMODB_TABLE'))
+    return _sightings_cache
+
+def countRegisteredPlate(item, plate):
+    """Adds a read to the seen_count of a registered plate, once per read.
+
+    The read's LprDataTable row is marked with the plate in the same
+    transaction, so the count is idempotent per plate_read_id whatever order
+    reads and redeliveries arrive in. Returns False when the read was already
+    counted.
+    """
+    lpr_table = awsclients.table('LPR_DYNAMODB_TABLE')
+    tracker_table = awsclients.table('REGISTERED_PLATE_TRACKER_TABLE')
+    client = lpr_table.meta.client
+    metrics.count('dynamodb_calls')
+    try:
+        with metrics.timer('dynamodb_write'):
+            client.transact_write_items(TransactItems=[
+                {
+                    'Update': {
+                        'TableName': lpr_table.name,
+                        'Key': {'plate_read_id': item['plate_read_id'], 'plate_read_timestamp': item['plate_read_timestamp']},
+                        'UpdateExpression': "SET counted_registered_plate = :plate",
+                        'ConditionExpression': "attribute_exists(plate_read_id) AND attribute_not_exists(counted_registered_plate)",
+                        'ExpressionAttributeValues': {':plate': plate},
+                    }
+                },
+                {
+                    'Update': {
+                        'TableName': tracker_table.name,
+                        'Key': {'plate_number': plate},
+                        'UpdateExpression': "ADD seen_count :val SET last_seen_timestamp = :ts",
+                        'ExpressionAttributeValues': {':val': 1, ':ts': item['plate_read_timestamp']},
+                    }
+                },
+            ])
+    except client.exceptions.TransactionCanceledException as e:
+        if [reason.get('Code') for reason in e.response.get('CancellationReasons', [])][:1] == ['ConditionalCheckFailed']:
+            return False
+        raise
+    return True
+
+def verifyPlateRead(item):
+    """Runs the entrance and exit checks for a single LprDataTable item."""
+    plate_read_id = item.get('plate_read_id')
+    plate_read_timestamp = item.get('plate_read_timestamp')
+    best_confidence = item.get('best_confidence')
+    best_plate_number = item.get('best_plate_number')
+    best_region = item.get('best_region')
+    camera_label = item.get('camera_label')
+    days_since_epoch = item.get('days_since_epoch')
+    plate_crop_jpeg_url = item.get('plate_crop_jpeg_url')
+    vehicle_crop_jpeg_url = item.get('vehicle_crop_jpeg_url')
+
+    # Every OCR candidate is checked, not just the best one.
+    read_plates = candidate_plates(item)
+
+    logger.info(f"Verifying plate_read_id: {plate_read_id} plate: {best_plate_number} Location: {camera_label}")
+
+    # Without a snapshot this raises, so the message is retried instead of going unverified.
+    snapshot = getPlateSnapshot()
+
+    # What a camera is for, and which site it belongs to, comes from the snapshot's camera roles.
+    site, role = snapshot.camera_role(camera_label)
+
+    if role == 'entrance':
+        # logger.info("Plate at Entrance - checking against registered plates.")
+        if not best_plate_number:
+            logger.info("No 'best_plate_number' in the item to check.")
+            return
+
+        # Look the candidates up in the registered plate index (exact, up to OCR
+        # confusions, or the best plate one edit away).
+        is_registered = False
+        with metrics.timer('fuzzy_match'):
+            plate = snapshot.find_any(read_plates)
+        if plate is not None:
+            is_registered = True
+            logger.info(f"MATCH FOUND: Detected plate '{best_plate_number}' matches registered plate '{plate}'.")
+
+            # Update the count for the matched registered plate. The read is marked as counted
+            # in the same transaction, so a redelivered message can't count it twice.
+            if not countRegisteredPlate(item, plate):
+                metrics.count('duplicate_reads')
+                logger.info(f"Read '{plate_read_id}' was already counted for registered plate '{plate}'.")
+
+        if is_registered == False:
+            logger.info(f"PLATE NOT FOUND IN REGISTERED VEHICLES: Detected plate '{best_plate_number}'.")
+
+            # Look for the plate among the valet sightings of the previous ten minutes,
+            # today and yesterday in case the 10-minute window crosses midnight.
+            ten_minutes_in_ms = 10 * 60 * 1000
+            start_timestamp = plate_read_timestamp - ten_minutes_in_ms
+            sightings = getSightingsCache()
+            sighting = None
+            for valet_camera in snapshot.cameras(site, 'valet'):
+                sighting = sightings.find(valet_camera, read_plates, (days_since_epoch, days_since_epoch - 1), start_timestamp, plate_read_timestamp)
+                if sighting is not None:
+                    break
+            logger.info(f"{len(sightings)} recent plates cached while checking {best_plate_number}.")
+
+            went_through_valet = False
+            if sighting is not None:
+                went_through_valet = True
+                logger.info(f"MATCH FOUND: Unregistered plate '{best_plate_number}' was seen at '{valet_camera}'.")
+
+            if went_through_valet:
+                # If a plate went through valet and is_registered is FALSE, it should be generating revenue.
+                logger.info(f"Plate '{best_plate_number}' is generating revenue.")
+
+                #Insert the plate into the valet_table with all of the information we have on it.
+                item = {
+                    'plate_read_id': plate_read_id,
+                    'best_plate_number': best_plate_number,
+                    'plate_read_timestamp': plate_read_timestamp,
+                    'best_confidence': best_confidence,
+                    'best_region': best_region,
+                    'days_since_epoch': getDaysSinceEpoch(),
+                    'plate_crop_jpeg_url': plate_crop_jpeg_url,
+                    'vehicle_crop_jpeg_url': vehicle_crop_jpeg_url,
+                    'revenue_received': 0
+                }
 
-def levenshtein(s1, s2):
+                # Remove keys with None values before inserting into DynamoDB
+                item_to_insert = {k: v for k, v in item.items() if v is not None}
 
-    if len(s1) < len(s2):
-        return levenshtein(s2, s1)
+                # Insert the plate into the valet table so we can track when it exits and how much money they owe.
+                # The ticket stays in the sparse OpenTicketIndex until it is paid.
+                if not getOpenTicketCache(site).open(item_to_insert):
+                    metrics.count('duplicate_reads')
+                    logger.info(f"Valet ticket '{plate_read_id}' was already opened.")
+            else:
+                # If a plate did not go through valet and is_registered is FALSE, it should be sent to security.
+                logger.info(f"Plate '{best_plate_number}' NOT seen at valet. Sending to security.")
 
-    if len(s2) == 0:
-        return len(s1)
+    # Process the garage exits to figure out how much money revenue we should be getting.
+    if role == 'exit':
+        logger.info("Plate seen exiting.")
 
-    previous_row = range(len(s2) + 1)
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
+        # Look the plate up among the open valet tickets from the last 30 days.
+        open_tickets = getOpenTicketCache(site)
+        matched_plate = open_tickets.find(read_plates)
+        logger.info(f"Found {len(open_tickets)} unpaid plates in the last 30 days.")
 
-    return previous_row[-1]
+        while matched_plate:
+            logger.info(f"MATCH FOUND: Exiting plate '{best_plate_number}' matches unpaid plate '{matched_plate.get('best_plate_number')}'.")
 
+            # Calculate the charge based on valet rates.
+            entry_timestamp = matched_plate.get('plate_read_timestamp')
+            exit_timestamp = plate_read_timestamp
+            duration_hours = (exit_timestamp - entry_timestamp) / tariff.MS_PER_HOUR
+            with metrics.timer('tariff'):
+                charge = tariff.charge(entry_timestamp, exit_timestamp)
+
+            # Update the record in the valet_table, unless another exit closed it first
+            # or this exit already paid for a ticket.
+            result = open_tickets.close(
+                matched_plate,
+                charge,
+                {'plate_read_id': plate_read_id, 'plate_read_timestamp': plate_read_timestamp}
+            )
+            if result == CLOSED:
+                logger.info(f"Charged ${charge} for {duration_hours:.2f} hours.")
+                break
+            if result == EXIT_ALREADY_CHARGED:
+                metrics.count('duplicate_reads')
+                logger.info(f"Exit '{plate_read_id}' already paid for a valet ticket.")
+                break
+
+            logger.info(f"Valet ticket '{matched_plate.get('plate_read_id')}' was already closed, looking for another match.")
+            matched_plate = open_tickets.find(read_plates)
+        else:
+            logger.info(f"No unpaid valet record found for exiting plate '{best_plate_number}'.")
+
+def getPlateReads(keys):
+    """Fetches LprDataTable items by primary key with BatchGetItem, 100 keys per request.
+
+    Unprocessed keys are retried with exponential backoff. Returns the items
+    keyed by plate_read_id.
+    """
+    lpr_table = awsclients.table('LPR_DYNAMODB_TABLE')
+    items = {}
+    unique_keys = list({key['plate_read_id']: key for key in keys}.values())
+    for i in range(0, len(unique_keys), BATCH_GET_ITEM_LIMIT):
+        request_items = {lpr_table.name: {'Keys': unique_keys[i:i + BATCH_GET_ITEM_LIMIT]}}
+        attempt = 0
+        while request_items:
+            with metrics.timer('dynamodb_read'):
+                response = awsclients.resource('dynamodb').batch_get_item(RequestItems=request_items)
+            metrics.count('dynamodb_calls')
+            for item in response.get('Responses', {}).get(lpr_table.name, []):
+                items[item['plate_read_id']] = item
+                metrics.count('dynamodb_items_scanned')
+
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                attempt += 1
+                if attempt > BATCH_GET_ITEM_MAX_RETRIES:
+                    raise RuntimeError(f"BatchGetItem left keys unprocessed after {BATCH_GET_ITEM_MAX_RETRIES} retries.")
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+    return items
+
+def prefetchSightings(items):
+    """Loads the valet sightings the entrance reads of a batch look at.
+
+    Only unregistered plates look at sightings, so registered ones are
+    skipped. Overlapping windows are merged, so reads close together in time
+    share one query per day partition.
+    """
+    snapshot = getPlateSnapshot()
+    sightings = getSightingsCache()
+    entrances = sorted(
+        (item['plate_read_timestamp'], item['days_since_epoch'])
+        for item in items
+        if snapshot.camera_role(item.get('camera_label'))[1] == 'entrance'
+        and item.get('plate_read_timestamp') is not None and item.get('days_since_epoch') is not None
+        and snapshot.find_any(candidate_plates(item)) is None
+    )
+    windows = []
+    for timestamp, day in entrances:
+        if windows and timestamp - sightings.window_ms <= windows[-1][1]:
+            windows[-1][1] = timestamp
+            windows[-1][2].update((day, day - 1))
+        else:
+            windows.append([timestamp - sightings.window_ms, timestamp, {day, day - 1}])
+    for start, end, days in windows:
+        sightings.load(sorted(days), start, end)
+
+def verifyPlateReadsInOrder(reads):
+    """Verifies (record, item) pairs one after another.
+
+    Returns the message ids of the read that failed and of every read after
+    it, since those may depend on it (an exit on its entrance).
+    """
+    for i, (record, item) in enumerate(reads):
+        try:
+            verifyPlateRead(item)
+            metrics.count('plate_reads')
+        except Exception as e:
+            logger.error(f"An error occurred processing message {record['messageId']}: {e}")
+            return [later_record['messageId'] for later_record, _ in reads[i:]]
+    return []
+
+def getPlateReadByGuid(guid):
+    """Looks up an LprDataTable item by plate_read_id alone."""
+    with metrics.timer('dynamodb_read'):
+        response = awsclients.table('LPR_DYNAMODB_TABLE').query(
+            KeyConditionExpression=Key('plate_read_id').eq(guid)
+        )
+    metrics.count('dynamodb_calls')
+    metrics.count('dynamodb_items_scanned', response.get('ScannedCount', len(response['Items'])))
+    # Assuming plate_read_id is unique, so we take the first item
+    return response['Items'][0] if response['Items'] else None
+
+@instrumented('verify')
 def verifylprdata(event, context):
-    logger.info(f"Received event: {json.dumps(event)}")
+    logger.info(f"Received {len(event['Records'])} messages.")
+
+    getSightingsCache().new_batch()
 
+    # Decode every message first so the plate reads of the whole batch can be fetched together.
+    messages = []
     for record in event['Records']:
         try:
-            item_guids = json.loads(record['body'])
-            logger.info(f"Processing GUIDs: {item_guids}")
+            # Decimal, not float: BatchGetItem rejects float keys, and older messages may hold some.
+            messages.append((record, json.loads(record['body'], parse_float=decimal.Decimal)))
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to decode JSON from SQS message body: {record['body']}. Error: {e}")
 
-            for guid in item_guids:
-                # Query DynamoDB to get the item using the plate_read_id
-                response = lpr_table.query(
-                    KeyConditionExpression=Key('plate_read_id').eq(guid)
-                )
+    try:
+        # Messages queued by older versions of the parse step only carry the GUID, not the full key.
+        keys = [
+            {'plate_read_id': plate_read['plate_read_id'], 'plate_read_timestamp': plate_read['plate_read_timestamp']}
+            for _, plate_reads in messages
+            for plate_read in plate_reads
+            if isinstance(plate_read, dict)
+        ]
+        items = getPlateReads(keys)
+    except Exception as e:
+        logger.error(f"Failed to fetch plate reads: {e}")
+        return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record, _ in messages]}
 
-                if response['Items']:
-                    # Assuming plate_read_id is unique, so we take the first item
-                    item = response['Items'][0]
-                    plate_read_id = item.get('plate_read_id')
-                    plate_read_timestamp = item.get('plate_read_timestamp')
-                    best_confidence = item.get('best_confidence')
-                    best_plate_number = item.get('best_plate_number')
-                    best_region = item.get('best_region')
-                    camera_label = item.get('camera_label')
-                    days_since_epoch = item.get('days_since_epoch')
-                    plate_crop_jpeg_url = item.get('plate_crop_jpeg_url')
-                    vehicle_crop_jpeg_url = item.get('vehicle_crop_jpeg_url')
-
-                    logger.info(f"Verifying plate_read_id: {plate_read_id} plate: {best_plate_number} Location: {camera_label}")
-
-                    if camera_label == '900 Garage Gate Entrance':
-                        # logger.info("Plate at Entrance - checking against registered plates.")
-                        # Load registered license plates from the file.
-                        try:
-                            # Assuming the text file is in the same directory as the handler.
-                            script_dir = os.path.dirname(__file__)
-                            file_path = os.path.join(script_dir, 'Registered_License_Plates.txt')
-                            with open(file_path, 'r') as f:
-                                registered_plates = [line.strip() for line in f if line.strip()]
-                        except FileNotFoundError:
-                            logger.error("Registered_License_Plates.txt not found.")
-                            return
-
-                        if not best_plate_number:
-                            logger.info("No 'best_plate_number' in the item to check.")
-                            return
-
-                        # Loop through registered plates and check for a match.
-                        is_registered = False
-                        for plate in registered_plates:
-                            
-                            if clean_levenshtein(plate, best_plate_number) <= 1:
-                                is_registered = True
-
-                            if is_registered:
-                                logger.info(f"MATCH FOUND: Detected plate '{best_plate_number}' matches registered plate '{plate}'.")
-                                
-                                # Update the count for the matched registered plate
-                                registered_plate_tracker_table.update_item(
-                                    Key={'plate_number': plate},
-                                    UpdateExpression="ADD seen_count :val SET last_seen_timestamp = :ts",
-                                    ExpressionAttributeValues={
-                                        ':val': 1,
-                                        ':ts': plate_read_timestamp
-                                    }
-                                )
-                                break
-                        
-                        if is_registered == False:
-                            logger.info(f"PLATE NOT FOUND IN REGISTERED VEHICLES: Detected plate '{best_plate_number}'.")
-
-                            # Get all plates from DynamoDB that happened in the previous ten minutes.
-                            ten_minutes_in_ms = 10 * 60 * 1000
-                            start_timestamp = plate_read_timestamp - ten_minutes_in_ms
-
-                            # Query for the current day
-                            query_response_today = lpr_table.query(
-                                IndexName='DaysSinceEpochIndex',
-                                KeyConditionExpression=Key('days_since_epoch').eq(days_since_epoch) & Key('plate_read_timestamp').between(start_timestamp, plate_read_timestamp)
-                            )
-
-                            # Query for the previous day in case the 10-minute window crosses midnight
-                            previous_days_since_epoch = days_since_epoch - 1
-                            query_response_yesterday = lpr_table.query(
-                                IndexName='DaysSinceEpochIndex',
-                                KeyConditionExpression=Key('days_since_epoch').eq(previous_days_since_epoch) & Key('plate_read_timestamp').between(start_timestamp, plate_read_timestamp)
-                            )
-
-                            recent_plates = query_response_today.get('Items', []) + query_response_yesterday.get('Items', [])
-                            logger.info(f"Found {len(recent_plates)} recent plates for {best_plate_number} in the last 10 minutes.")
-
-                            # Check if any of the recent plates were at the valet.
-                            went_through_valet = False
-                            for p in recent_plates:
-                                lev_distance_result = levenshtein(p.get('best_plate_number'), best_plate_number)
-                                if p.get('camera_label') == '900 Valet' and lev_distance_result <= 1:
-                                    went_through_valet = True
-                                    logger.info(f"MATCH FOUND: Unregistered plate '{best_plate_number}' was seen at '900 Valet'.")
-                                    break
-                            
-                            if went_through_valet:
-                                # If a plate went through valet and is_registered is FALSE, it should be generating revenue.
-                                logger.info(f"Plate '{best_plate_number}' is generating revenue.")
-                                
-                                #Insert the plate into the valet_table with all of the information we have on it.
-                                item = {
-                                    'plate_read_id': plate_read_id,
-                                    'best_plate_number': best_plate_number,
-                                    'plate_read_timestamp': plate_read_timestamp,
-                                    'best_confidence': best_confidence,
-                                    'best_region': best_region,
-                                    'days_since_epoch': getDaysSinceEpoch(),
-                                    'plate_crop_jpeg_url': plate_crop_jpeg_url,
-                                    'vehicle_crop_jpeg_url': vehicle_crop_jpeg_url,
-                                    'revenue_received': 0
-                                }
-
-                                # Remove keys with None values before inserting into DynamoDB
-                                item_to_insert = {k: v for k, v in item.items() if v is not None}
-
-                                # Insert the plate into the valet table so we can track when it exits and how much money they owe.
-                                valet_table.put_item(Item=item_to_insert)
-                            else:
-                                # If a plate did not go through valet and is_registered is FALSE, it should be sent to security.
-                                logger.info(f"Plate '{best_plate_number}' NOT seen at valet. Sending to security.")
-
-                    # Process the garage exits to figure out how much money revenue we should be getting.
-                    if camera_label == '900 Garage Gate Exit':
-                        logger.info("Plate seen exiting.")
-                        
-                        # Download all plates from the valet_table for the last 30 days where revenue has not been received.
-                        current_day = getDaysSinceEpoch()
-                        unpaid_plates = []
-                        for i in range(30):
-                            day_to_check = current_day - i
-                            response = valet_table.query(
-                                IndexName='DaysSinceEpochIndex',
-                                KeyConditionExpression=Key('days_since_epoch').eq(day_to_check) & Key('revenue_received').eq(0)
-                            )
-                            unpaid_plates.extend(response.get('Items', []))
-                        
-                        logger.info(f"Found {len(unpaid_plates)} unpaid plates in the last 30 days.")
-
-                        # Check if the exiting plate matches any of the unpaid plates.
-                        matched_plate = None
-                        for plate in unpaid_plates:
-                            if clean_levenshtein(plate.get('best_plate_number'), best_plate_number) <= 1:
-                                matched_plate = plate
-                                break
-                        
-                        if matched_plate:
-                            logger.info(f"MATCH FOUND: Exiting plate '{best_plate_number}' matches unpaid plate '{matched_plate.get('best_plate_number')}'.")
-                            
-                            # Calculate the time difference in hours.
-                            entry_timestamp = matched_plate.get('plate_read_timestamp')
-                            exit_timestamp = plate_read_timestamp
-                            duration_ms = exit_timestamp - entry_timestamp
-                            duration_hours = duration_ms / (1000 * 60 * 60)
-                            
-                            charge = 0
-                            if duration_hours > 24:
-                                charge = int(duration_hours / 24) * 36
-                                duration_hours = duration_hours % 24
-
-                            # Calculate the charge based on valet rates.
-                            if duration_hours <= 2:
-                                charge += 15
-                            elif duration_hours <= 8:
-                                charge += 20
-                            elif duration_hours <= 12:
-                                charge += 24
-                            elif duration_hours <= 24:
-                                charge += 36
-                            
-                            # Update the record in the valet_table.
-                            valet_table.update_item(
-                                Key={
-                                    'plate_read_id': matched_plate.get('plate_read_id'),
-                                    'plate_read_timestamp': matched_plate.get('plate_read_timestamp')
-                                },
-                                UpdateExpression="set revenue_received = :r",
-                                ExpressionAttributeValues={
-                                    ':r': int(charge)
-                                },
-                                ReturnValues="UPDATED_NEW"
-                            )
-                            logger.info(f"Charged ${charge} for {duration_hours:.2f} hours.")
-                        else:
-                            logger.info(f"No unpaid valet record found for exiting plate '{best_plate_number}'.")
+    failed_message_ids = set()
+    reads = []
+    for record, plate_reads in messages:
+        try:
+            message_reads = []
+            for plate_read in plate_reads:
+                if isinstance(plate_read, dict):
+                    guid = plate_read['plate_read_id']
+                    item = items.get(guid)
                 else:
-                    logger.warning(f"No item found in DynamoDB for plate_read_id: {guid}")
+                    guid = plate_read
+                    item = getPlateReadByGuid(guid)
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON from SQS message body: {record['body']}. Error: {e}")
+                if item:
+                    message_reads.append((record, item))
+                else:
+                    logger.warning(f"No item found in DynamoDB for plate_read_id: {guid}")
+            reads.extend(message_reads)
         except Exception as e:
-            logger.error(f"An error occurred: {e}")
-            # Depending on the error, you might want to re-raise it to have the message retried
-            # For now, we log and continue to avoid blocking the queue for one bad message.
-            pass
-
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Successfully processed verification messages.')
-    }
+            logger.error(f"An error occurred processing message {record['messageId']}: {e}")
+            failed_message_ids.add(record['messageId'])
+
+    # Shared by the worker threads, so they are set up before any of them starts.
+    try:
+        getPlateSnapshot()
+        prefetchSightings([item for _, item in reads])
+    except Exception as e:
+        logger.error(f"Failed to prepare the batch, reads will be looked up one by one: {e}")
+
+    # Reads that could be the same vehicle are verified in time order on one thread,
+    # so an entrance always opens its ticket before the exit looks for it.
+    groups = group_related(reads, lambda read: plate_tokens(candidate_plates(read[1])))
+    for group in groups:
+        group.sort(key=lambda read: read[1].get('plate_read_timestamp') or 0)
+    metrics.count('plate_groups', len(groups))
+
+    if VERIFY_CONCURRENCY > 1 and len(groups) > 1:
+        results = list(getVerifyExecutor().map(verifyPlateReadsInOrder, groups))
+    else:
+        results = [verifyPlateReadsInOrder(group) for group in groups]
+    for message_ids in results:
+        failed_message_ids.update(message_ids)
+
+    # Report the failed messages so SQS retries them; the rest of the batch is deleted.
+    batch_item_failures = [
+        {'itemIdentifier': record['messageId']}
+        for record, _ in messages
+        if record['messageId'] in failed_message_ids
+    ]
+
+    plate_reads = metrics.value('plate_reads')
+    if plate_reads:
+        metrics.count('plate_comparisons_per_record', metrics.value('plate_comparisons') / plate_reads)
+    metrics.count('failed_messages', len(batch_item_failures))
+    return {'batchItemFailures': batch_item_failures}
@@ -0,0 +1,200 @@
+"""Benchmarks for the plate matching kernels.
+
+Run with pytest-benchmark:
+
+    python -m pytest benchmarks/bench_matching.py
+
+Each benchmark looks up the same set of noisy plates against the registered
+plate list and checks that it returns the same answers as the original
+clean_levenshtein scan that verifyhandlers used before the PlateIndex.
+"""
+import importlib.util
+import os
+import random
+
+import pytest
+
+from conftest import PARSE_AND_VERIFY_DIR
+from plateindex import PlateIndex
+from platematching import (MAX_CONFUSED_CHARACTERS, PlateArray, batch_bounded_levenshtein, bounded_levenshtein,
+                           canonical_plate, clean_within_distance, confused_characters, normalize_plate)
+from platesnapshot import PlateSnapshot, build_snapshot
+
+ALPHABET = 'ABCDEFGHJKLMNPRSTUVWXYZ0123456789'
+
+
+# The original verifyhandlers matching, kept as the reference for every benchmark.
+def clean_levenshtein(s1, s2):
+    s1 = s1.lower().replace('-', '').replace(' ', '')
+    s2 = s2.lower().replace('-', '').replace(' ', '')
+    return levenshtein(s1, s2)
+
+
+def levenshtein(s1, s2):
+
+    if len(s1) < len(s2):
+        return levenshtein(s2, s1)
+
+    if len(s2) == 0:
+        return len(s1)
+
+    previous_row = range(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            insertions = previous_row[j + 1] + 1
+            deletions = current_row[j] + 1
+            substitutions = previous_row[j] + (c1 != c2)
+            current_row.append(min(insertions, deletions, substitutions))
+        previous_row = current_row
+
+    return previous_row[-1]
+
+
+def _registered_plates():
+    with open(os.path.join(PARSE_AND_VERIFY_DIR, 'Registered_License_Plates.txt')) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _noisy(plate, rng):
+    """Applies up to two random edits to plate."""
+    chars = list(plate)
+    for _ in range(rng.randint(0, 2)):
+        position = rng.randint(0, len(chars))
+        operation = rng.choice(('insert', 'delete', 'substitute'))
+        if operation == 'insert':
+            chars.insert(position, rng.choice(ALPHABET))
+        elif chars:
+            position = min(position, len(chars) - 1)
+            if operation == 'delete':
+                del chars[position]
+            else:
+                chars[position] = rng.choice(ALPHABET)
+    return ''.join(chars)
+
+
+REGISTERED = _registered_plates()
+_rng = random.Random(900)
+QUERIES = [_noisy(_rng.choice(REGISTERED), _rng) for _ in range(50)]
+
+
+def _first_match_levenshtein(query):
+    for plate in REGISTERED:
+        if clean_levenshtein(plate, query) <= 1:
+            return plate
+    return None
+
+
+EXPECTED = [_first_match_levenshtein(query) for query in QUERIES]
+# OCR candidates per read, best plate first.
+CANDIDATES = [[query] + [_noisy(query, _rng) for _ in range(3)] for query in QUERIES]
+
+
+def test_levenshtein_scan(benchmark):
+    result = benchmark(lambda: [_first_match_levenshtein(query) for query in QUERIES])
+    assert result == EXPECTED
+
+
+def test_bounded_levenshtein_scan(benchmark):
+    normalized = [normalize_plate(plate) for plate in REGISTERED]
+
+    def run():
+        matches = []
+        for query in QUERIES:
+            key = normalize_plate(query)
+            matches.append(next((REGISTERED[i] for i, plate in enumerate(normalized)
+                                 if bounded_levenshtein(plate, key, 1) <= 1), None))
+        return matches
+
+    assert benchmark(run) == EXPECTED
+
+
+def test_within_distance_scan(benchmark):
+    def run():
+        return [next((plate for plate in REGISTERED if clean_within_distance(plate, query)), None)
+                for query in QUERIES]
+
+    assert benchmark(run) == EXPECTED
+
+
+@pytest.mark.skipif(importlib.util.find_spec('numpy') is None, reason='NumPy is not installed')
+def test_batch_bounded_levenshtein(benchmark):
+    packed = PlateArray(normalize_plate(plate) for plate in REGISTERED)
+
+    def run():
+        matches = []
+        for query in QUERIES:
+            hits = (batch_bounded_levenshtein(normalize_plate(query), packed, 1) <= 1).nonzero()[0]
+            matches.append(REGISTERED[hits[0]] if len(hits) else None)
+        return matches
+
+    assert benchmark(run) == EXPECTED
+
+
+def test_plate_index(benchmark):
+    index = PlateIndex(REGISTERED)
+    assert benchmark(lambda: [index.find(query) for query in QUERIES]) == EXPECTED
+
+
+def _reference_find_any(candidates, registered):
+    """PlateIndex.find_any by brute force, with the position in registered as the rank."""
+    keys = list(dict.fromkeys(normalize_plate(plate) for plate in candidates if plate))
+    best, best_order = None, None
+    for position, key in enumerate(keys):
+        for rank, plate in enumerate(registered):
+            indexed = normalize_plate(plate)
+            if indexed == key:
+                order = (0, position, 0, rank)
+            elif canonical_plate(indexed) == canonical_plate(key) \
+                    and confused_characters(key, indexed) <= MAX_CONFUSED_CHARACTERS:
+                order = (1, position, confused_characters(key, indexed), rank)
+            else:
+                continue
+            if best_order is None or order < best_order:
+                best, best_order = plate, order
+    if best is not None or not keys:
+        return best
+    return next((plate for plate in registered if clean_levenshtein(plate, keys[0]) <= 1), None)
+
+
+EXPECTED_ANY = [_reference_find_any(candidates, REGISTERED) for candidates in CANDIDATES]
+
+
+def test_plate_index_find_any(benchmark):
+    index = PlateIndex(REGISTERED)
+    result = benchmark(lambda: [index.find_any(candidates) for candidates in CANDIDATES])
+    assert result == EXPECTED_ANY
+
+
+def test_find_any_bounds_confused_characters():
+    index = PlateIndex(['0OD0Q1', 'KN085D'])
+    # Every character differs, but only within confusion classes.
+    assert index.find_any(['QDO0O1']) is None
+    assert index.find_any(['KN0B5D']) == 'KN085D'
+    assert index.find_any(['KNO8SD']) is None
+
+
+def test_plate_snapshot_find_any(benchmark):
+    snapshot = PlateSnapshot(build_snapshot(REGISTERED, {}))
+    result = benchmark(lambda: [snapshot.find_any(candidates) for candidates in CANDIDATES])
+    assert result == EXPECTED_ANY
+
+
+@pytest.mark.parametrize('plates', [['AB1234', 'AB1235'], ['AB1235', 'AB1234']])
+def test_plate_snapshot_ties_keep_file_order(plates):
+    # Both are one edit from the read, so the plate listed first wins, as in a PlateIndex.
+    snapshot = PlateSnapshot(build_snapshot(plates + [plates[0]], {}))
+    assert len(snapshot) == 2
+    assert snapshot.find_any(['AB123X']) == plates[0]
+    assert PlateIndex(plates).find_any(['AB123X']) == plates[0]
+
+
+@pytest.mark.parametrize('k', [0, 1, 2])
+def test_bounded_matches_full_distance(k):
+    rng = random.Random(k)
+    for _ in range(2000):
+        s1 = _noisy(rng.choice(REGISTERED), rng)
+        s2 = _noisy(rng.choice(REGISTERED), rng) if rng.random() < 0.5 else _noisy(s1, rng)
+        expected = min(levenshtein(s1, s2), k + 1)
+        assert bounded_levenshtein(s1, s2, k) == expected
+        assert batch_bounded_levenshtein(s1, [s2], k)[0] == expected
@@ -0,0 +1,209 @@
+"""Cold start benchmark for the three Lambda handlers.
+
+Every run starts a fresh interpreter, the way Lambda starts a new container,
+and measures:
+
+- boto3_import_ms: importing boto3 itself
+- handler_import_ms: importing the handler module (boto3 already loaded)
+- first_invocation_ms: the first call of the handler
+- warm_invocation_ms: the second call of the handler
+
+AWS is stubbed at the HTTP layer with a botocore before-send hook, so clients
+are created and requests are serialized and parsed as usual, but nothing
+leaves the machine. Results are the median over --runs runs.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --update-baseline
+
+When benchmarks/startup_baseline.json exists the results are compared with
+it and the script exits with status 1 if any figure is more than --tolerance
+times its baseline value.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, 'startup_baseline.json')
+PARSE_AND_VERIFY_DIR = os.path.join(REPO_DIR, 'LicensePlateParseAndVerify')
+EXAMPLE_PATH = os.path.join(PARSE_AND_VERIFY_DIR, 'example_plate_read.json')
+
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+    'LPR_DYNAMODB_TABLE': 'LprDataTable',
+    'VALET_DYNAMODB_TABLE': 'ValetRevenueTracking',
+    'REGISTERED_PLATE_TRACKER_TABLE': 'RegisteredPlateTracker',
+    'IMAGE_BUCKET_NAME': 'lpr-images',
+    'COMPLETED_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/lpr-parse-and-store-completed',
+}
+
+METRICS = ('boto3_import_ms', 'handler_import_ms', 'first_invocation_ms', 'warm_invocation_ms')
+
+
+def _example_read():
+    with open(EXAMPLE_PATH) as f:
+        return json.load(f)
+
+
+def _ingestion_event():
+    return {'body': json.dumps(_example_read())}
+
+
+def _parse_event():
+    notification = {'Records': [{'s3': {'bucket': {'name': 'lpr-ingestion'}, 'object': {'key': 'bench'}}}]}
+    return {'Records': [{'messageId': 'bench', 'body': json.dumps(notification)}]}
+
+
+def _verify_event():
+    keys = [{'plate_read_id': f'bench-{i}', 'plate_read_timestamp': 1754188918813 + i} for i in range(10)]
+    return {'Records': [{'messageId': 'bench', 'body': json.dumps(keys)}]}
+
+
+HANDLERS = {
+    'ingestion': ('LicensePlateIngestion', 'receive_data_handler', 'receivelprdata', _ingestion_event),
+    'parse': ('LicensePlateParseAndVerify', 'parsehandlers', 'receivelprdata', _parse_event),
+    'verify': ('LicensePlateParseAndVerify', 'verifyhandlers', 'verifylprdata', _verify_event),
+}
+
+
+class _RawBody(io.BytesIO):
+    def stream(self, **kwargs):
+        yield self.getvalue()
+
+
+def _stub_response(request, event_name, **kwargs):
+    """Answers every AWS request with a canned, successful response."""
+    from botocore.awsrequest import AWSResponse
+
+    operation = event_name.rsplit('.', 1)[-1]
+    body = json.loads(request.body) if request.body and request.body[:1] in (b'{', '{') else {}
+    headers = {'Content-Type': 'application/x-amz-json-1.0'}
+    payload = {}
+
+    if operation == 'BatchGetItem':
+        responses = {}
+        for table_name, request_items in body['RequestItems'].items():
+            responses[table_name] = [dict(key, best_plate_number={'S': 'KN085D'},
+                                          camera_label={'S': '900 Garage Gate Entrance'},
+                                          days_since_epoch={'N': '20303'})
+                                     for key in request_items['Keys']]
+        payload = {'Responses': responses, 'UnprocessedKeys': {}}
+    elif operation in ('Query', 'Scan'):
+        payload = {'Items': [], 'Count': 0, 'ScannedCount': 0}
+    elif operation == 'BatchWriteItem':
+        payload = {'UnprocessedItems': {}}
+    elif operation == 'SendMessage':
+        payload = {'MessageId': 'bench', 'MD5OfMessageBody': hashlib.md5(body['MessageBody'].encode()).hexdigest()}
+    elif operation == 'PutRecordBatch':
+        payload = {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': 'bench'} for _ in body['Records']]}
+    elif operation == 'PutRecord':
+        payload = {'RecordId': 'bench'}
+    elif operation == 'GetObject':
+        data = ''.join(json.dumps(_example_read()) + ',\n' for _ in range(20)).encode()
+        return AWSResponse(request.url, 200, {'Content-Length': str(len(data))}, _RawBody(data))
+    elif operation in ('PutObject', 'HeadObject'):
+        return AWSResponse(request.url, 200, {'ETag': '"bench"'}, _RawBody(b''))
+
+    return AWSResponse(request.url, 200, headers, _RawBody(json.dumps(payload).encode()))
+
+
+def _child(name):
+    service_dir, module_name, function_name, make_event = HANDLERS[name]
+    sys.path.insert(0, os.path.join(REPO_DIR, service_dir))
+    event = make_event()
+
+    started = time.perf_counter()
+    import boto3
+    boto3_imported = time.perf_counter()
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-send', _stub_response)
+
+    hooked = time.perf_counter()
+    module = __import__(module_name)
+    imported = time.perf_counter()
+    handler = getattr(module, function_name)
+    handler(event, None)
+    first = time.perf_counter()
+    handler(event, None)
+    warm = time.perf_counter()
+
+    print(json.dumps({
+        'boto3_import_ms': (boto3_imported - started) * 1000,
+        'handler_import_ms': (imported - hooked) * 1000,
+        'first_invocation_ms': (first - imported) * 1000,
+        'warm_invocation_ms': (warm - first) * 1000,
+    }))
+
+
+def measure(runs):
+    """Returns the median of each metric per handler over runs fresh interpreters."""
+    results = {}
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        # Built ahead of the runs and packaged with the handler, as deploy.sh does.
+        snapshot_path = os.path.join(snapshot_dir, 'registered_plates.snapshot')
+        subprocess.run(
+            [sys.executable, 'platesnapshot.py', 'Registered_License_Plates.txt', 'camera_roles.json', snapshot_path],
+            cwd=PARSE_AND_VERIFY_DIR, check=True, capture_output=True
+        )
+        env = dict(os.environ, PLATE_SNAPSHOT_PATH=snapshot_path, **ENVIRONMENT)
+        for name in HANDLERS:
+            samples = []
+            for _ in range(runs):
+                output = subprocess.run(
+                    [sys.executable, __file__, '--child', name],
+                    env=env, check=True, capture_output=True, text=True
+                ).stdout
+                samples.append(json.loads(output.strip().splitlines()[-1]))
+            results[name] = {metric: round(statistics.median(s[metric] for s in samples), 2) for metric in METRICS}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child)
+        return 0
+
+    results = measure(args.runs)
+    print(json.dumps(results, indent=2))
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        return 0
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+
+    regressed = False
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baseline.get(name, {}).get(metric)
+            if expected and value > expected * args.tolerance:
+                print(f"REGRESSION: {name} {metric} {value:.2f} ms (baseline {expected:.2f} ms)")
+                regressed = True
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,15 @@
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARSE_AND_VERIFY_DIR = os.path.join(REPO_DIR, 'LicensePlateParseAndVerify')
+INGESTION_DIR = os.path.join(REPO_DIR, 'LicensePlateIngestion')
+
+sys.path.insert(0, INGESTION_DIR)
+sys.path.insert(0, PARSE_AND_VERIFY_DIR)
+
+# awsclients.table looks the table names up in the environment.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('LPR_DYNAMODB_TABLE', 'LprDataTable')
+os.environ.setdefault('VALET_DYNAMODB_TABLE', 'ValetRevenueTracking')
+os.environ.setdefault('REGISTERED_PLATE_TRACKER_TABLE', 'RegisteredPlateTracker')
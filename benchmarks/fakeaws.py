@@ -0,0 +1,479 @@
+"""In-memory stand-ins for the AWS services the pipeline uses.
+
+These implement just enough of the boto3 client and resource APIs for the
+handlers in this repository: S3 objects, an SQS queue, a Firehose delivery
+stream that is flushed into S3 files on demand, and DynamoDB tables with
+global secondary indexes (including sparse ones), boto3 condition objects,
+simple update expressions, batch_writer and TransactWriteItems updates with
+attribute_exists / attribute_not_exists conditions.
+
+Every backend call goes through FakeAWS.call, which counts it by service and
+operation and can add a fixed simulated round-trip latency.
+"""
+import collections
+import copy
+import decimal
+import hashlib
+import io
+import re
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+class FakeAWS:
+    """Shared call counter and simulated latency for all fakes."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def call(self, service, operation, count=1):
+        with self._lock:
+            self.calls[f'{service}.{operation}'] += count
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class FakeS3:
+    def __init__(self, aws):
+        self.aws = aws
+        self.objects = {}
+        self.bytes_uploaded = 0
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.aws.call('s3', 'GetObject')
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError('NoSuchKey', 'GetObject')
+        data = self.objects[(Bucket, Key)]
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if IfNoneMatch == etag:
+            raise FakeClientError('304', 'GetObject')
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body=b'', IfNoneMatch=None, **kwargs):
+        self.aws.call('s3', 'PutObject')
+        data = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+        # The body is sent before S3 checks the condition.
+        self.bytes_uploaded += len(data)
+        if IfNoneMatch == '*' and (Bucket, Key) in self.objects:
+            raise FakeClientError('PreconditionFailed', 'PutObject')
+        self.objects[(Bucket, Key)] = data
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.aws.call('s3', 'HeadObject')
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError('404', 'HeadObject')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+
+class FakeSQS:
+    def __init__(self, aws):
+        self.aws = aws
+        self.messages = collections.deque()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.aws.call('sqs', 'SendMessage')
+        message_id = str(uuid.uuid4())
+        self.messages.append({'messageId': message_id, 'body': MessageBody})
+        return {'MessageId': message_id}
+
+    def receive(self, max_messages):
+        """Takes up to max_messages messages off the queue as SQS event records."""
+        records = []
+        while self.messages and len(records) < max_messages:
+            records.append(self.messages.popleft())
+        return records
+
+
+class FakeFirehose:
+    def __init__(self, aws):
+        self.aws = aws
+        self.buffer = []
+
+    def put_record(self, DeliveryStreamName, Record):
+        self.aws.call('firehose', 'PutRecord')
+        self.buffer.append(Record['Data'])
+        return {'RecordId': str(uuid.uuid4())}
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.aws.call('firehose', 'PutRecordBatch')
+        self.buffer.extend(record['Data'] for record in Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': str(uuid.uuid4())} for _ in Records]}
+
+    def flush(self):
+        """Returns the buffered records as one delivered file and empties the buffer."""
+        data = b''.join(d if isinstance(d, bytes) else d.encode('utf-8') for d in self.buffer)
+        self.buffer = []
+        return data
+
+
+class FakeClientError(ClientError):
+    def __init__(self, code, operation):
+        super().__init__({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class ConditionalCheckFailedException(FakeClientError):
+    def __init__(self, operation):
+        super().__init__('ConditionalCheckFailedException', operation)
+
+
+class TransactionCanceledException(FakeClientError):
+    def __init__(self, codes):
+        super().__init__('TransactionCanceledException', 'TransactWriteItems')
+        self.response['CancellationReasons'] = [{'Code': code} for code in codes]
+
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    TransactionCanceledException = TransactionCanceledException
+
+
+class _Client:
+    exceptions = _Exceptions
+
+
+class _Meta:
+    def __init__(self, client):
+        self.client = client
+
+
+def to_dynamodb(value):
+    """Converts a value the way boto3's serializer does: ints become Decimal, floats are rejected."""
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, decimal.Decimal)):
+        return value
+    if isinstance(value, int):
+        return decimal.Decimal(value)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        return {k: to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {to_dynamodb(v) for v in value}
+    raise TypeError(f'Unsupported type {type(value).__name__} for DynamoDB.')
+
+
+def evaluate(condition, item):
+    """Evaluates a boto3 Key or Attr condition against an item."""
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    if operator == 'AND':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if operator == 'OR':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if operator == 'NOT':
+        return not evaluate(values[0], item)
+
+    name = values[0].name
+    if operator == 'attribute_exists':
+        return name in item
+    if operator == 'attribute_not_exists':
+        return name not in item
+    if name not in item:
+        return False
+
+    value = item[name]
+    if operator == '=':
+        return value == values[1]
+    if operator == '<>':
+        return value != values[1]
+    if operator == '<':
+        return value < values[1]
+    if operator == '<=':
+        return value <= values[1]
+    if operator == '>':
+        return value > values[1]
+    if operator == '>=':
+        return value >= values[1]
+    if operator == 'BETWEEN':
+        return values[1] <= value <= values[2]
+    if operator == 'begins_with':
+        return value.startswith(values[1])
+    if operator == 'IN':
+        return value in values[1]
+    raise NotImplementedError(f'Condition operator {operator} is not supported by the fake.')
+
+
+def _hash_value(condition, hash_key):
+    """Finds the equality on hash_key in a key condition."""
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        for part in expression['values']:
+            value = _hash_value(part, hash_key)
+            if value is not None:
+                return value
+    elif expression['operator'] == '=' and expression['values'][0].name == hash_key:
+        return expression['values'][1]
+    return None
+
+
+_EXISTENCE = re.compile(r'^(attribute_exists|attribute_not_exists)\((\w+)\)$')
+
+
+def evaluate_string(condition, item):
+    """Evaluates a ConditionExpression string of AND-ed attribute_exists / attribute_not_exists checks."""
+    for clause in re.split(r'\s+AND\s+', condition.strip(), flags=re.IGNORECASE):
+        match = _EXISTENCE.match(clause.strip())
+        if match is None:
+            raise NotImplementedError(f'Condition {clause!r} is not supported by the fake.')
+        if (match.group(2) in item) != (match.group(1) == 'attribute_exists'):
+            return False
+    return True
+
+
+_CLAUSE = re.compile(r'\b(SET|ADD|REMOVE|DELETE)\b', re.IGNORECASE)
+
+
+def apply_update(item, update_expression, names, values):
+    """Applies a SET / ADD / REMOVE update expression to item in place."""
+    def attribute(token):
+        token = token.strip()
+        return names.get(token, token)
+
+    parts = _CLAUSE.split(update_expression)
+    for keyword, body in zip(parts[1::2], parts[2::2]):
+        keyword = keyword.upper()
+        for action in (a.strip() for a in body.split(',') if a.strip()):
+            if keyword == 'SET':
+                target, operand = (t.strip() for t in action.split('=', 1))
+                item[attribute(target)] = values[operand] if operand.startswith(':') else item[attribute(operand)]
+            elif keyword == 'ADD':
+                target, operand = action.split()
+                item[attribute(target)] = item.get(attribute(target), 0) + values[operand]
+            elif keyword == 'REMOVE':
+                item.pop(attribute(action), None)
+            else:
+                raise NotImplementedError('DELETE updates are not supported by the fake.')
+
+
+class FakeTable:
+    """A DynamoDB table with hash-partitioned primary key and secondary indexes."""
+
+    meta = _Meta(_Client)
+
+    def __init__(self, aws, name, hash_key, range_key=None, indexes=None):
+        self.aws = aws
+        self.name = name
+        self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = dict(indexes or {})
+        self.items = {}
+        self._partitions = {None: collections.defaultdict(dict)}
+        for index_name in self.indexes:
+            self._partitions[index_name] = collections.defaultdict(dict)
+        self._lock = threading.RLock()
+
+    def _key(self, item):
+        return (item[self.hash_key], item[self.range_key]) if self.range_key else (item[self.hash_key],)
+
+    def _schema(self, index_name):
+        return (self.hash_key, self.range_key) if index_name is None else self.indexes[index_name]
+
+    def _unindex(self, key, item):
+        for index_name, partitions in self._partitions.items():
+            hash_key, _ = self._schema(index_name)
+            if hash_key in item:
+                partitions[item[hash_key]].pop(key, None)
+
+    def _index(self, key, item):
+        for index_name, partitions in self._partitions.items():
+            hash_key, range_key = self._schema(index_name)
+            # Items missing an index key attribute are left out of it, like a sparse GSI.
+            if hash_key in item and (range_key is None or range_key in item):
+                partitions[item[hash_key]][key] = item
+
+    def _store(self, item):
+        key = self._key(item)
+        with self._lock:
+            existing = self.items.get(key)
+            if existing is not None:
+                self._unindex(key, existing)
+            self.items[key] = item
+            self._index(key, item)
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        self.aws.call('dynamodb', 'PutItem')
+        with self._lock:
+            existing = self.items.get(self._key(Item))
+            if ConditionExpression is not None and not evaluate(ConditionExpression, existing or {}):
+                raise ConditionalCheckFailedException('PutItem')
+            self._store(to_dynamodb(Item))
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        self.aws.call('dynamodb', 'GetItem')
+        item = self.items.get(self._key(Key))
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+                    ConditionExpression=None, ReturnValues=None, **kwargs):
+        self.aws.call('dynamodb', 'UpdateItem')
+        with self._lock:
+            existing = self.items.get(self._key(Key))
+            if ConditionExpression is not None and not evaluate(ConditionExpression, existing or {}):
+                raise ConditionalCheckFailedException('UpdateItem')
+            item = copy.deepcopy(existing) if existing is not None else to_dynamodb(dict(Key))
+            apply_update(item, UpdateExpression, ExpressionAttributeNames or {}, to_dynamodb(ExpressionAttributeValues or {}))
+            self._store(item)
+        return {'Attributes': copy.deepcopy(item)} if ReturnValues else {}
+
+    def delete_item(self, Key, **kwargs):
+        self.aws.call('dynamodb', 'DeleteItem')
+        key = self._key(Key)
+        with self._lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self._unindex(key, item)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, ScanIndexForward=True, **kwargs):
+        self.aws.call('dynamodb', 'Query')
+        hash_key, range_key = self._schema(IndexName)
+        hash_value = _hash_value(KeyConditionExpression, hash_key)
+        with self._lock:
+            candidates = list(self._partitions[IndexName].get(hash_value, {}).values())
+        items = [item for item in candidates if evaluate(KeyConditionExpression, item)]
+        if range_key:
+            items.sort(key=lambda item: item[range_key], reverse=not ScanIndexForward)
+        scanned = len(items)
+        if FilterExpression is not None:
+            items = [item for item in items if evaluate(FilterExpression, item)]
+        return {'Items': copy.deepcopy(items), 'Count': len(items), 'ScannedCount': scanned}
+
+    def scan(self, FilterExpression=None, **kwargs):
+        self.aws.call('dynamodb', 'Scan')
+        with self._lock:
+            items = list(self.items.values())
+        scanned = len(items)
+        if FilterExpression is not None:
+            items = [item for item in items if evaluate(FilterExpression, item)]
+        return {'Items': copy.deepcopy(items), 'Count': len(items), 'ScannedCount': scanned}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _FakeBatchWriter(self)
+
+
+class _FakeBatchWriter:
+    """Buffers put_item calls and writes them 25 at a time, like boto3's batch_writer."""
+
+    def __init__(self, table):
+        self.table = table
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+    def put_item(self, Item):
+        self.buffer.append(to_dynamodb(Item))
+        if len(self.buffer) >= 25:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.table.aws.call('dynamodb', 'BatchWriteItem')
+        for item in self.buffer:
+            self.table._store(item)
+        self.buffer = []
+
+
+class FakeDynamoDB:
+    """Resource-style entry point: Table lookups and batch_get_item."""
+
+    def __init__(self, aws, tables):
+        self.aws = aws
+        self.tables = {table.name: table for table in tables}
+        self.meta = _Meta(_FakeDynamoDBClient(self))
+        for table in tables:
+            table.meta = self.meta
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        self.aws.call('dynamodb', 'BatchGetItem')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.tables[table_name]
+            found = (table.items.get(table._key(key)) for key in request['Keys'])
+            responses[table_name] = [copy.deepcopy(item) for item in found if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class _FakeDynamoDBClient(_Client):
+    """The low-level client behind the resource, for TransactWriteItems."""
+
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        self.dynamodb.aws.call('dynamodb', 'TransactWriteItems')
+        updates = []
+        for transact_item in TransactItems:
+            if set(transact_item) != {'Update'}:
+                raise NotImplementedError('Only Update transaction items are supported by the fake.')
+            update = transact_item['Update']
+            updates.append((self.dynamodb.tables[update['TableName']], update))
+
+        tables = sorted({table.name: table for table, _ in updates}.items())
+        for _, table in tables:
+            table._lock.acquire()
+        try:
+            codes = []
+            for table, update in updates:
+                existing = table.items.get(table._key(update['Key']))
+                condition = update.get('ConditionExpression')
+                passed = condition is None or evaluate_string(condition, existing or {})
+                codes.append('None' if passed else 'ConditionalCheckFailed')
+            if 'ConditionalCheckFailed' in codes:
+                raise TransactionCanceledException(codes)
+            for table, update in updates:
+                existing = table.items.get(table._key(update['Key']))
+                item = copy.deepcopy(existing) if existing is not None else to_dynamodb(dict(update['Key']))
+                apply_update(item, update['UpdateExpression'], update.get('ExpressionAttributeNames') or {},
+                             to_dynamodb(update.get('ExpressionAttributeValues') or {}))
+                table._store(item)
+        finally:
+            for _, table in reversed(tables):
+                table._lock.release()
+        return {}
+
+
+def create_pipeline_backend(latency_ms=0.0):
+    """Builds the fakes for the whole pipeline, with the tables defined in serverless.yml."""
+    aws = FakeAWS(latency_ms)
+    lpr_table = FakeTable(aws, 'LprDataTable', 'plate_read_id', 'plate_read_timestamp', {
+        'DaysSinceEpochIndex': ('days_since_epoch', 'plate_read_timestamp'),
+    })
+    valet_table = FakeTable(aws, 'ValetRevenueTracking', 'plate_read_id', 'plate_read_timestamp', {
+        'DaysSinceEpochIndex': ('days_since_epoch', 'revenue_received'),
+        'OpenTicketIndex': ('open_ticket_site', 'plate_read_timestamp'),
+    })
+    tracker_table = FakeTable(aws, 'RegisteredPlateTracker', 'plate_number')
+    return {
+        'aws': aws,
+        's3': FakeS3(aws),
+        'sqs': FakeSQS(aws),
+        'firehose': FakeFirehose(aws),
+        'dynamodb': FakeDynamoDB(aws, [lpr_table, valet_table, tracker_table]),
+        'lpr_table': lpr_table,
+        'valet_table': valet_table,
+        'tracker_table': tracker_table,
+    }
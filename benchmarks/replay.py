@@ -0,0 +1,365 @@
+"""Local end-to-end replay of the license plate pipeline.
+
+Generates synthetic camera traffic from example_plate_read.json and drives it
+through the real handlers against the in-memory fakes in fakeaws.py:
+
+    ingestion (receive_data_handler.receivelprdata)
+      -> Firehose, flushed into one S3 file per --file-size reads
+      -> parse (parsehandlers.receivelprdata)
+      -> completed queue, drained in batches of up to 10 messages
+      -> verify (verifyhandlers.verifylprdata)
+
+Traffic is made of vehicle journeys, mixed with --mix:
+
+- registered: a registered plate at the garage entrance
+- valet: a valet sighting, the garage entrance a few minutes later, and an
+  exit some hours after that
+- unregistered: an unknown plate at the entrance that never went through valet
+- stray-exit: an exit with no valet ticket
+
+--noise is the chance that a read's best plate carries an OCR error, and
+--repeat adds duplicate reads of the same sighting a second or two apart.
+
+Reports throughput, p50/p99 latency per stage, backend call counts and the
+business outcome (tickets opened and charged, registered plates seen), so a
+change can be checked for both speed and behaviour:
+
+    python benchmarks/replay.py --vehicles 2000
+    python benchmarks/replay.py --vehicles 500 --latency-ms 5 --json results.json
+"""
+import argparse
+import base64
+import contextlib
+import copy
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+INGESTION_DIR = os.path.join(REPO_DIR, 'LicensePlateIngestion')
+PARSE_AND_VERIFY_DIR = os.path.join(REPO_DIR, 'LicensePlateParseAndVerify')
+
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, INGESTION_DIR)
+sys.path.insert(0, PARSE_AND_VERIFY_DIR)
+
+import fakeaws  # noqa: E402
+
+INGESTION_BUCKET = 'lpr-ingestion'
+IMAGE_BUCKET = 'lpr-images'
+SNAPSHOT_BUCKET = 'lpr-plate-snapshots'
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'LPR_DYNAMODB_TABLE': 'LprDataTable',
+    'VALET_DYNAMODB_TABLE': 'ValetRevenueTracking',
+    'REGISTERED_PLATE_TRACKER_TABLE': 'RegisteredPlateTracker',
+    'IMAGE_BUCKET_NAME': IMAGE_BUCKET,
+    'COMPLETED_QUEUE_URL': 'lpr-parse-and-store-completed',
+    'PLATE_SNAPSHOT_URI': f's3://{SNAPSHOT_BUCKET}/registered_plates.snapshot',
+}
+
+ENTRANCE = '900 Garage Gate Entrance'
+VALET = '900 Valet'
+EXIT = '900 Garage Gate Exit'
+
+PLATE_CHARACTERS = 'ABCDEFGHJKLMNPRSTUVWXYZ0123456789'
+OCR_CONFUSIONS = {'0': 'OD', 'O': '0D', 'D': '0O', '5': 'S', 'S': '5', '8': 'B', 'B': '8', '1': 'I', 'I': '1'}
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {'registered', 'valet', 'unregistered', 'stray-exit'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown journey types: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class TrafficGenerator:
+    """Builds plate reads for synthetic vehicle journeys."""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        with open(os.path.join(PARSE_AND_VERIFY_DIR, 'example_plate_read.json')) as f:
+            self.template = json.load(f)
+        with open(os.path.join(PARSE_AND_VERIFY_DIR, 'Registered_License_Plates.txt')) as f:
+            self.registered = [line.strip() for line in f if line.strip()]
+
+    def random_plate(self):
+        return ''.join(self.rng.choice(PLATE_CHARACTERS) for _ in range(self.rng.randint(5, 7)))
+
+    def misread(self, plate):
+        """Applies one OCR-style error to plate."""
+        position = self.rng.randrange(len(plate))
+        character = plate[position]
+        if character in OCR_CONFUSIONS and self.rng.random() < 0.7:
+            return plate[:position] + self.rng.choice(OCR_CONFUSIONS[character]) + plate[position + 1:]
+        operation = self.rng.choice(('substitute', 'delete', 'insert'))
+        if operation == 'substitute':
+            return plate[:position] + self.rng.choice(PLATE_CHARACTERS) + plate[position + 1:]
+        if operation == 'delete' and len(plate) > 2:
+            return plate[:position] + plate[position + 1:]
+        return plate[:position] + self.rng.choice(PLATE_CHARACTERS) + plate[position:]
+
+    def crop(self):
+        if not self.args.crop_bytes:
+            return ''
+        return base64.b64encode(self.rng.randbytes(self.args.crop_bytes)).decode('ascii')
+
+    def sighting(self, plate, camera_label, timestamp):
+        """Returns the reads a camera reports for one sighting of plate."""
+        plate_crop = self.crop()
+        vehicle_crop = self.crop()
+        reads = []
+        for repeat in range(1 + self.args.repeat):
+            seen_as = self.misread(plate) if self.rng.random() < self.args.noise else plate
+            candidates = [seen_as] + [self.misread(seen_as) for _ in range(3)]
+            if seen_as != plate and self.rng.random() < 0.7:
+                # The OCR usually lists the true plate among the alternatives of a misread.
+                candidates.insert(self.rng.randint(1, 3), plate)
+            confidence = round(self.rng.uniform(75, 95), 4)
+
+            read = copy.deepcopy(self.template)
+            read['epoch_start'] = timestamp + repeat * self.rng.randint(500, 2000)
+            read['epoch_end'] = read['epoch_start'] + 1500
+            read['best_plate_number'] = seen_as
+            read['best_confidence'] = confidence
+            read['best_plate']['plate'] = seen_as
+            read['best_plate']['confidence'] = confidence
+            read['best_plate']['plate_crop_jpeg'] = plate_crop
+            read['vehicle_crop_jpeg'] = vehicle_crop
+            read['candidates'] = [
+                {'plate': candidate, 'confidence': round(confidence - 10 * i, 4), 'matches_template': 0}
+                for i, candidate in enumerate(candidates)
+            ]
+            read['web_server_config']['camera_label'] = camera_label
+            reads.append(read)
+        return reads
+
+    def journeys(self, count, start_ms, span_ms):
+        """Returns (reads, expected outcome counts) for count vehicles arriving over span_ms."""
+        names = list(self.args.mix)
+        weights = [self.args.mix[name] for name in names]
+        reads = []
+        expected = {name: 0 for name in names}
+        for _ in range(count):
+            kind = self.rng.choices(names, weights)[0]
+            expected[kind] += 1
+            arrival = start_ms + self.rng.randrange(span_ms)
+            if kind == 'registered':
+                reads += self.sighting(self.rng.choice(self.registered), ENTRANCE, arrival)
+            elif kind == 'valet':
+                plate = self.random_plate()
+                reads += self.sighting(plate, VALET, arrival)
+                reads += self.sighting(plate, ENTRANCE, arrival + self.rng.randint(1, 5) * MINUTE_MS)
+                stay = self.rng.randint(30 * MINUTE_MS, 30 * HOUR_MS)
+                reads += self.sighting(plate, EXIT, arrival + 5 * MINUTE_MS + stay)
+            elif kind == 'unregistered':
+                reads += self.sighting(self.random_plate(), ENTRANCE, arrival)
+            else:
+                reads += self.sighting(self.random_plate(), EXIT, arrival)
+        reads.sort(key=lambda read: read['epoch_start'])
+        return reads, expected
+
+
+class StageTimer:
+    """Times handler invocations and adds up the metrics they write to stdout."""
+
+    def __init__(self):
+        self.samples = {}
+        self.metrics = {}
+
+    def time(self, stage, handler, event):
+        output = io.StringIO()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            result = handler(event, None)
+        self.samples.setdefault(stage, []).append((time.perf_counter() - started) * 1000)
+
+        totals = self.metrics.setdefault(stage, {})
+        for line in output.getvalue().splitlines():
+            if not line.startswith('{"_aws"'):
+                print(line)
+                continue
+            document = json.loads(line)
+            for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                name = metric['Name']
+                totals[name] = totals.get(name, 0) + document[name]
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            summary[stage] = {
+                'invocations': len(samples),
+                'p50_ms': round(statistics.median(ordered), 3),
+                'p99_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+                'total_s': round(sum(ordered) / 1000, 3),
+                'metrics': {name: round(value, 3) for name, value in sorted(self.metrics.get(stage, {}).items())},
+            }
+            plate_reads = summary[stage]['metrics'].get('plate_reads')
+            if plate_reads and 'plate_comparisons' in summary[stage]['metrics']:
+                # A ratio can't be summed over invocations, so work it out from the totals.
+                summary[stage]['metrics']['plate_comparisons_per_record'] = round(
+                    summary[stage]['metrics']['plate_comparisons'] / plate_reads, 3)
+        return summary
+
+
+def publish_snapshot(s3):
+    """Publishes a snapshot of the bundled plates and camera roles, as deploy.sh does."""
+    from platesnapshot import build_snapshot
+
+    with open(os.path.join(PARSE_AND_VERIFY_DIR, 'Registered_License_Plates.txt')) as f:
+        plates = f.read().splitlines()
+    with open(os.path.join(PARSE_AND_VERIFY_DIR, 'camera_roles.json')) as f:
+        camera_roles = json.load(f)
+    s3.objects[(SNAPSHOT_BUCKET, 'registered_plates.snapshot')] = build_snapshot(plates, camera_roles)
+
+
+def run(args):
+    os.environ.update(ENVIRONMENT)
+    backend = fakeaws.create_pipeline_backend(args.latency_ms)
+
+    import awsclients
+    import parsehandlers
+    import receive_data_handler
+    import reconcile
+    import verifyhandlers
+
+    # The handler modules set the root logger to INFO when they are imported.
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+
+    receive_data_handler.firehose = backend['firehose']
+    awsclients.install('client', 's3', backend['s3'])
+    awsclients.install('client', 'sqs', backend['sqs'])
+    awsclients.install('resource', 'dynamodb', backend['dynamodb'])
+    awsclients.install('table', 'LPR_DYNAMODB_TABLE', backend['lpr_table'])
+    awsclients.install('table', 'VALET_DYNAMODB_TABLE', backend['valet_table'])
+    awsclients.install('table', 'REGISTERED_PLATE_TRACKER_TABLE', backend['tracker_table'])
+    publish_snapshot(backend['s3'])
+
+    rng = random.Random(args.seed)
+    generator = TrafficGenerator(args, rng)
+    # Arrivals over the day before the last 36 hours, so every exit is in the past.
+    now_ms = int(time.time() * 1000)
+    reads, journeys = generator.journeys(args.vehicles, now_ms - 60 * HOUR_MS, 24 * HOUR_MS)
+
+    timer = StageTimer()
+    failed_messages = 0
+    started = time.perf_counter()
+    for file_number, first in enumerate(range(0, len(reads), args.file_size)):
+        file_reads = reads[first:first + args.file_size]
+        for i in range(0, len(file_reads), args.request_size):
+            request = file_reads[i:i + args.request_size]
+            body = json.dumps(request[0]) if len(request) == 1 else '\n'.join(json.dumps(r) for r in request)
+            response = timer.time('ingestion', receive_data_handler.receivelprdata, {'body': body})
+            if response['statusCode'] != 200:
+                raise RuntimeError(f"Ingestion failed: {response['body']}")
+
+        object_key = f'firehose/{file_number:06d}'
+        backend['s3'].objects[(INGESTION_BUCKET, object_key)] = backend['firehose'].flush()
+        notification = {'Records': [{'s3': {'bucket': {'name': INGESTION_BUCKET}, 'object': {'key': object_key}}}]}
+        timer.time('parse', parsehandlers.receivelprdata,
+                   {'Records': [{'messageId': object_key, 'body': json.dumps(notification)}]})
+
+        while backend['sqs'].messages:
+            records = backend['sqs'].receive(args.verify_batch_size)
+            response = timer.time('verify', verifyhandlers.verifylprdata, {'Records': records})
+            failed_messages += len((response or {}).get('batchItemFailures', []))
+    elapsed = time.perf_counter() - started
+
+    tickets = list(backend['valet_table'].items.values())
+    backend_calls = dict(sorted(backend['aws'].calls.items()))
+    # The offline reconciliation should find every charge the verify step made correct.
+    snapshot = verifyhandlers.getPlateSnapshot()
+    range_start_ms = now_ms - 84 * HOUR_MS
+    camera_sites = {label: site for site in snapshot.camera_roles for label in snapshot.cameras(site, 'exit')}
+    reconciliation = reconcile.reconcile(reconcile.query_tickets(backend['valet_table'], range_start_ms, now_ms),
+                                         reconcile.query_reads(backend['lpr_table'], range_start_ms, now_ms, camera_sites),
+                                         range_start_ms, now_ms, camera_sites)
+    return {
+        'reads': len(reads),
+        'vehicles': journeys,
+        'elapsed_s': round(elapsed, 3),
+        'reads_per_s': round(len(reads) / elapsed, 1),
+        'stages': timer.summary(),
+        'backend_calls': backend_calls,
+        'outcome': {
+            'lpr_items': len(backend['lpr_table'].items),
+            'valet_tickets_opened': len(tickets),
+            'valet_tickets_charged': sum(1 for t in tickets if t.get('revenue_received')),
+            'revenue': int(sum(t.get('revenue_received', 0) for t in tickets)),
+            'registered_plates_seen': int(sum(t.get('seen_count', 0) for t in backend['tracker_table'].items.values())),
+            'images_uploaded_bytes': backend['s3'].bytes_uploaded,
+            'failed_verify_messages': failed_messages,
+            'reconciled_mispriced': len(reconciliation['mispriced']),
+            'reconciled_unmatched_tickets': len(reconciliation['unmatched_tickets']),
+        },
+    }
+
+
+def report(results):
+    print(f"{results['reads']} reads from {sum(results['vehicles'].values())} vehicles "
+          f"({', '.join(f'{k} {v}' for k, v in results['vehicles'].items())})")
+    print(f"{results['elapsed_s']:.2f} s, {results['reads_per_s']:.1f} reads/s")
+    print()
+    print(f"{'stage':<10} {'calls':>7} {'p50 ms':>10} {'p99 ms':>10} {'total s':>9}")
+    for stage, summary in results['stages'].items():
+        print(f"{stage:<10} {summary['invocations']:>7} {summary['p50_ms']:>10.2f} "
+              f"{summary['p99_ms']:>10.2f} {summary['total_s']:>9.2f}")
+    for stage, summary in results['stages'].items():
+        if summary['metrics']:
+            print()
+            print(f'{stage} metrics (summed over invocations)')
+            for name, value in summary['metrics'].items():
+                print(f"  {name:<28} {value:>12}")
+    print()
+    print('backend calls')
+    for call, count in results['backend_calls'].items():
+        print(f"  {call:<28} {count:>8}")
+    print()
+    print('outcome')
+    for name, value in results['outcome'].items():
+        print(f"  {name:<28} {value:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vehicles', type=int, default=1000, help='number of vehicle journeys')
+    parser.add_argument('--mix', type=_parse_mix, default=_parse_mix('registered=5,valet=3,unregistered=1,stray-exit=1'),
+                        help='relative weights of the journey types')
+    parser.add_argument('--noise', type=float, default=0.1, help='chance a read has an OCR error in its best plate')
+    parser.add_argument('--repeat', type=int, default=0, help='extra reads reported per sighting')
+    parser.add_argument('--crop-bytes', type=int, default=2048, help='size of each synthetic crop image')
+    parser.add_argument('--file-size', type=int, default=200, help='reads per Firehose file')
+    parser.add_argument('--request-size', type=int, default=1, help='reads per ingestion request')
+    parser.add_argument('--verify-batch-size', type=int, default=10, help='SQS messages per verify invocation')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated latency of every backend call')
+    parser.add_argument('--seed', type=int, default=900)
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
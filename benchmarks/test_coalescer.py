@@ -0,0 +1,104 @@
+"""Tests for ReadCoalescer in coalescer.py."""
+import pytest
+
+from coalescer import IMPROVED, NEW, REPEAT, ReadCoalescer
+
+WINDOW_MS = 10 * 1000
+START = 1_750_000_000_000
+
+
+def read(plate_read_id, plate='ABC123', seconds=0, confidence=80, camera='900 Garage Gate Entrance', **fields):
+    return dict({
+        'plate_read_id': plate_read_id,
+        'plate_read_timestamp': START + seconds * 1000,
+        'epoch_start': START + seconds * 1000,
+        'best_plate_number': plate,
+        'best_confidence': confidence,
+        'camera_label': camera,
+    }, **fields)
+
+
+@pytest.fixture
+def coalescer():
+    return ReadCoalescer(window_ms=WINDOW_MS)
+
+
+def test_repeat_within_the_window(coalescer):
+    with coalescer.batch():
+        first = read('r1')
+        assert coalescer.coalesce(first) == (NEW, first)
+        # Same camera and normalized plate.
+        assert coalescer.coalesce(read('r2', plate='abc-123', seconds=4)) == (REPEAT, None)
+        other_camera = read('r3', seconds=4, camera='900 Valet')
+        assert coalescer.coalesce(other_camera) == (NEW, other_camera)
+        other_plate = read('r4', plate='XYZ789', seconds=4)
+        assert coalescer.coalesce(other_plate) == (NEW, other_plate)
+
+
+def test_window_is_measured_from_the_first_read(coalescer):
+    with coalescer.batch():
+        coalescer.coalesce(read('r1', seconds=0))
+        assert coalescer.coalesce(read('r2', seconds=6))[0] == REPEAT
+        # Only 6 s after the previous read, but 12 s after the first.
+        assert coalescer.coalesce(read('r3', seconds=12))[0] == NEW
+        assert coalescer.coalesce(read('r4', seconds=20))[0] == REPEAT
+
+
+def test_improved_repeat_rewrites_the_stored_item_and_keeps_its_crops(coalescer):
+    with coalescer.batch():
+        stored = read('r1', confidence=70, candidates=[{'plate': 'A8C123'}],
+                      plate_crop_jpeg_url='https://images/plate.jpg', vehicle_crop_jpeg_url='https://images/vehicle.jpg')
+        coalescer.coalesce(stored)
+        assert coalescer.coalesce(read('r2', seconds=2, confidence=60)) == (REPEAT, None)
+        better = read('r3', seconds=3, confidence=90, candidates=[{'plate': 'ABC128'}],
+                      vehicle_crop_jpeg_url='https://images/better.jpg')
+        kind, improved = coalescer.coalesce(better)
+    assert kind == IMPROVED
+    # Still the stored read, with the better read's plate data.
+    assert improved['plate_read_id'] == 'r1'
+    assert improved['plate_read_timestamp'] == stored['plate_read_timestamp']
+    assert improved['epoch_start'] == stored['epoch_start']
+    assert improved['best_confidence'] == 90
+    assert improved['candidates'] == [{'plate': 'ABC128'}]
+    assert improved['plate_crop_jpeg_url'] == 'https://images/plate.jpg'
+    assert improved['vehicle_crop_jpeg_url'] == 'https://images/better.jpg'
+
+
+def test_better_repeat_of_an_earlier_batch_is_dropped(coalescer):
+    with coalescer.batch():
+        coalescer.coalesce(read('r1', confidence=70))
+    # The first item may already have been verified, so it is never rewritten.
+    with coalescer.batch():
+        assert coalescer.coalesce(read('r2', seconds=3, confidence=95)) == (REPEAT, None)
+
+
+def test_failed_batch_forgets_every_group(coalescer):
+    with pytest.raises(RuntimeError):
+        with coalescer.batch():
+            coalescer.coalesce(read('r1'))
+            raise RuntimeError('write failed')
+    assert len(coalescer) == 0
+    with coalescer.batch():
+        assert coalescer.coalesce(read('r2', seconds=1))[0] == NEW
+
+
+def test_groups_are_evicted(coalescer):
+    coalescer.max_groups = 2
+    with coalescer.batch():
+        for i, plate in enumerate(['AAA111', 'BBB222', 'CCC333']):
+            coalescer.coalesce(read(f'r{i}', plate=plate))
+        assert len(coalescer) == 2
+        coalescer.coalesce(read('r3', plate='DDD444', seconds=11))
+        # The others were first seen more than the window before the newest read.
+        assert len(coalescer) == 1
+
+
+def test_disabled_or_incomplete_reads_are_always_new():
+    coalescer = ReadCoalescer(window_ms=0)
+    with coalescer.batch():
+        coalescer.coalesce(read('r1'))
+        assert coalescer.coalesce(read('r2', seconds=1))[0] == NEW
+    coalescer = ReadCoalescer(window_ms=WINDOW_MS)
+    with coalescer.batch():
+        assert coalescer.coalesce(read('r1', plate=None))[0] == NEW
+        assert coalescer.coalesce(read('r2', plate=None))[0] == NEW
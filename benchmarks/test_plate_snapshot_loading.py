@@ -0,0 +1,50 @@
+"""Tests for how verifyhandlers loads the registered plate snapshot."""
+import pytest
+
+import awsclients
+import fakeaws
+import verifyhandlers
+from platesnapshot import build_snapshot, write_snapshot
+
+URI = 's3://lpr-plate-snapshots/registered_plates.snapshot'
+
+
+class DeniedS3:
+    """S3 without s3:ListBucket, which answers AccessDenied for a missing object."""
+
+    def get_object(self, **kwargs):
+        raise fakeaws.FakeClientError('AccessDenied', 'GetObject')
+
+
+@pytest.fixture
+def loader(monkeypatch, tmp_path):
+    packaged = tmp_path / 'registered_plates.snapshot'
+    monkeypatch.setattr(verifyhandlers, 'PLATE_SNAPSHOT_URI', URI)
+    monkeypatch.setattr(verifyhandlers, 'PLATE_SNAPSHOT_PATH', str(packaged))
+    monkeypatch.setattr(verifyhandlers, 'DOWNLOADED_SNAPSHOT_PATH', str(tmp_path / 'downloaded.snapshot'))
+    monkeypatch.setattr(verifyhandlers, '_plate_snapshot', None)
+    monkeypatch.setattr(verifyhandlers, '_plate_snapshot_etag', None)
+    return packaged
+
+
+def use_s3(monkeypatch, s3):
+    monkeypatch.setitem(awsclients._clients, ('client', 's3'), s3)
+
+
+def test_packaged_snapshot_is_used_until_one_is_published(monkeypatch, loader):
+    write_snapshot(str(loader), ['ABC123'], {}, version=1)
+    use_s3(monkeypatch, DeniedS3())
+    snapshot = verifyhandlers.getPlateSnapshot()
+    assert snapshot.version == 1 and snapshot.find('ABC123') == 'ABC123'
+
+    s3 = fakeaws.create_pipeline_backend()['s3']
+    s3.objects[('lpr-plate-snapshots', 'registered_plates.snapshot')] = build_snapshot(['ABC123', 'XYZ789'], {}, version=2)
+    use_s3(monkeypatch, s3)
+    verifyhandlers._plate_snapshot_checked_at -= verifyhandlers.PLATE_SNAPSHOT_CHECK_SECONDS
+    assert verifyhandlers.getPlateSnapshot().version == 2
+
+
+def test_no_snapshot_at_all_fails(monkeypatch, loader):
+    use_s3(monkeypatch, DeniedS3())
+    with pytest.raises(fakeaws.FakeClientError):
+        verifyhandlers.getPlateSnapshot()
@@ -0,0 +1,131 @@
+"""Tests for the ingestion handler in LicensePlateIngestion/receive_data_handler.py."""
+import base64
+import json
+
+import pytest
+
+import receive_data_handler
+from receive_data_handler import MAX_BATCH_BYTES, MAX_BATCH_RECORDS, batchRecords, receivelprdata, splitPlateReads
+
+READS = [{'plate_read_id': f'read-{i}', 'best_plate_number': 'ABC123'} for i in range(3)]
+
+
+class StubFirehose:
+    """Fails the records whose index is in failing, and every record of a batch that starts at a failing_batches index."""
+
+    def __init__(self, failing=(), failing_batches=(), retry_succeeds=False):
+        self.failing = set(failing)
+        self.failing_batches = set(failing_batches)
+        self.retry_succeeds = retry_succeeds
+        self.delivered = []
+        self._sent = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        first = self._sent
+        self._sent += len(Records)
+        if first in self.failing_batches:
+            raise RuntimeError('ServiceUnavailable')
+        responses = []
+        for i, record in enumerate(Records, first):
+            if i in self.failing:
+                responses.append({'ErrorCode': 'ServiceUnavailableException'})
+            else:
+                responses.append({'RecordId': str(i)})
+                self.delivered.append(record['Data'])
+        return {'FailedPutCount': sum('ErrorCode' in r for r in responses), 'RequestResponses': responses}
+
+    def put_record(self, DeliveryStreamName, Record):
+        if not self.retry_succeeds:
+            raise RuntimeError('ServiceUnavailable')
+        self.delivered.append(Record['Data'])
+        return {'RecordId': 'retried'}
+
+
+@pytest.fixture
+def firehose(monkeypatch):
+    def install(stub):
+        monkeypatch.setattr(receive_data_handler, 'firehose', stub)
+        return stub
+    return install
+
+
+def test_split_array():
+    assert [json.loads(read) for read in splitPlateReads(json.dumps(READS))] == READS
+
+
+def test_split_newline_delimited():
+    body = '\n'.join(json.dumps(read) for read in READS) + '\n\n'
+    assert splitPlateReads(body) == [json.dumps(read) for read in READS]
+
+
+def test_split_single_object_is_passed_through():
+    body = '{"plate_read_id": "read-0",  "best_plate_number": "ABC123"}'
+    assert splitPlateReads(f'  {body}\n') == [body]
+
+
+@pytest.mark.parametrize('body', [None, '', '  \n', '[]', '[1, 2]', '42', '{"a": 1}\n[1]', 'not json'])
+def test_split_rejects_bodies_without_plate_reads(body):
+    with pytest.raises(ValueError):
+        splitPlateReads(body)
+
+
+def test_batches_hold_at_most_500_records():
+    records = [{'Data': b'x'} for _ in range(2 * MAX_BATCH_RECORDS + 1)]
+    assert [len(batch) for batch in batchRecords(records)] == [MAX_BATCH_RECORDS, MAX_BATCH_RECORDS, 1]
+
+
+def test_batches_hold_at_most_4_mib():
+    quarter = MAX_BATCH_BYTES // 4
+    # Exactly 4 MiB fits; one more byte starts a new batch.
+    records = [{'Data': b'x' * quarter} for _ in range(4)] + [{'Data': b'x'}, {'Data': b'x' * MAX_BATCH_BYTES}]
+    assert [len(batch) for batch in batchRecords(records)] == [4, 1, 1]
+    assert all(sum(len(record['Data']) for record in batch) <= MAX_BATCH_BYTES for batch in batchRecords(records))
+
+
+def test_all_records_delivered(firehose):
+    stub = firehose(StubFirehose())
+    response = receivelprdata({'body': json.dumps(READS)}, None)
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['records'] == 3
+    assert [json.loads(data.decode()[:-2]) for data in stub.delivered] == READS
+
+
+def test_base64_body(firehose):
+    firehose(StubFirehose())
+    body = base64.b64encode(json.dumps(READS[0]).encode()).decode()
+    assert receivelprdata({'body': body, 'isBase64Encoded': True}, None)['statusCode'] == 200
+
+
+@pytest.mark.parametrize('event', [{'body': None}, {}, {'body': ''}, {'body': None, 'isBase64Encoded': True}])
+def test_empty_body_is_a_bad_request(firehose, event):
+    firehose(StubFirehose())
+    assert receivelprdata(event, None)['statusCode'] == 400
+
+
+def test_rejected_record_is_retried(firehose):
+    stub = firehose(StubFirehose(failing={1}, retry_succeeds=True))
+    response = receivelprdata({'body': json.dumps(READS)}, None)
+    assert response['statusCode'] == 200
+    assert len(stub.delivered) == 3
+
+
+def test_partial_failure_reports_the_failed_records(firehose):
+    firehose(StubFirehose(failing={1}))
+    response = receivelprdata({'body': json.dumps(READS)}, None)
+    assert response['statusCode'] == 207
+    body = json.loads(response['body'])
+    assert body['records'] == 3
+    assert body['failed_records'] == [1]
+
+
+def test_failed_batch_reports_only_its_records(firehose):
+    reads = [{'plate_read_id': f'read-{i}'} for i in range(MAX_BATCH_RECORDS + 2)]
+    firehose(StubFirehose(failing_batches={MAX_BATCH_RECORDS}))
+    response = receivelprdata({'body': json.dumps(reads)}, None)
+    assert response['statusCode'] == 207
+    assert json.loads(response['body'])['failed_records'] == [MAX_BATCH_RECORDS, MAX_BATCH_RECORDS + 1]
+
+
+def test_nothing_delivered_is_a_server_error(firehose):
+    firehose(StubFirehose(failing_batches={0}))
+    assert receivelprdata({'body': json.dumps(READS)}, None)['statusCode'] == 500
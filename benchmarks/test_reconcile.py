@@ -0,0 +1,109 @@
+"""Tests for the offline revenue reconciliation in reconcile.py."""
+import fakeaws
+import reconcile
+from tariff import MS_PER_DAY, MS_PER_HOUR
+from valettickets import TICKET_WINDOW_MS
+
+DAY = 20_000
+START = DAY * MS_PER_DAY
+CAMERA_SITES = {'900 Garage Gate Exit': '900', '901 Garage Gate Exit': '901'}
+
+
+def ticket(plate_read_id, plate, timestamp, site='900', revenue=0):
+    item = {'plate_read_id': plate_read_id, 'best_plate_number': plate, 'plate_read_timestamp': timestamp,
+            'days_since_epoch': timestamp // MS_PER_DAY, 'revenue_received': revenue}
+    if site is not None:
+        item['site'] = site
+    return item
+
+
+def exit_read(plate_read_id, plate, timestamp, site='900', candidates=()):
+    return {'plate_read_id': plate_read_id, 'best_plate_number': plate, 'plate_read_timestamp': timestamp,
+            'days_since_epoch': timestamp // MS_PER_DAY, 'camera_label': f'{site} Garage Gate Exit',
+            'candidates': [{'plate': plate} for plate in candidates]}
+
+
+def pair_ids(pairs):
+    return [(ticket['plate_read_id'], read['plate_read_id']) for ticket, read in pairs]
+
+
+def test_pair_exits_matches_candidate_plates():
+    tickets = [ticket('t1', 'ABC123', START)]
+    exits = [exit_read('e1', 'A8C1Z3', START + MS_PER_HOUR, candidates=['ABC123'])]
+    pairs, unmatched = reconcile.pair_exits(tickets, exits, CAMERA_SITES)
+    assert pair_ids(pairs) == [('t1', 'e1')]
+    assert unmatched == []
+
+
+def test_pair_exits_keeps_sites_apart():
+    tickets = [ticket('t1', 'ABC123', START, site='900'), ticket('t2', 'ABC123', START + 1, site='901')]
+    exits = [exit_read('e1', 'ABC123', START + MS_PER_HOUR, site='900')]
+    pairs, _ = reconcile.pair_exits(tickets, exits, CAMERA_SITES)
+    # t2 is newer, but belongs to the other site.
+    assert pair_ids(pairs) == [('t1', 'e1')]
+
+
+def test_pair_exits_tickets_without_site_belong_to_default_site():
+    tickets = [ticket('t1', 'ABC123', START, site=None)]
+    exits = [exit_read('e1', 'ABC123', START + MS_PER_HOUR, site='901'),
+             exit_read('e2', 'ABC123', START + 2 * MS_PER_HOUR, site='900')]
+    pairs, unmatched = reconcile.pair_exits(tickets, exits, CAMERA_SITES)
+    assert pair_ids(pairs) == [('t1', 'e2')]
+    assert [read['plate_read_id'] for read in unmatched] == ['e1']
+
+
+def test_pair_exits_newest_ticket_first():
+    tickets = [ticket('t1', 'ABC123', START), ticket('t2', 'ABC123', START + MS_PER_HOUR)]
+    exits = [exit_read('e1', 'ABC123', START + 2 * MS_PER_HOUR), exit_read('e2', 'ABC123', START + 3 * MS_PER_HOUR)]
+    pairs, _ = reconcile.pair_exits(tickets, exits, CAMERA_SITES)
+    assert pair_ids(pairs) == [('t2', 'e1'), ('t1', 'e2')]
+
+
+def test_pair_exits_ignores_later_and_expired_tickets():
+    tickets = [ticket('t1', 'ABC123', START), ticket('t2', 'XYZ789', START + 2 * MS_PER_HOUR)]
+    exits = [exit_read('e1', 'XYZ789', START + MS_PER_HOUR),
+             exit_read('e2', 'ABC123', START + TICKET_WINDOW_MS + 1)]
+    pairs, unmatched = reconcile.pair_exits(tickets, exits, CAMERA_SITES)
+    assert pairs == []
+    assert [read['plate_read_id'] for read in unmatched] == ['e1', 'e2']
+
+
+def test_reconcile_reports_tickets_opened_before_the_range():
+    tickets = [
+        # Opened before the range and closed by an exit before it: not reported.
+        ticket('t0', 'OLD111', START - 2 * MS_PER_DAY, revenue=15),
+        # Opened before the range and closed in it, with the wrong charge.
+        ticket('t1', 'ABC123', START - MS_PER_HOUR, revenue=15),
+        ticket('t2', 'XYZ789', START + MS_PER_HOUR),
+    ]
+    exits = [
+        exit_read('e0', 'OLD111', START - 2 * MS_PER_DAY + MS_PER_HOUR),
+        exit_read('e1', 'ABC123', START + 3 * MS_PER_HOUR),
+    ]
+    results = reconcile.reconcile(tickets, exits, START, START + MS_PER_DAY, CAMERA_SITES)
+    assert results['tickets'] == 1
+    assert results['paired'] == 1
+    assert [(t['plate_read_id'], t['expected'], t['received']) for t in results['mispriced']] == [('t1', 20, 15)]
+    assert [t['plate_read_id'] for t in results['unmatched_tickets']] == ['t2']
+    assert results['unmatched_exits'] == []
+
+
+def test_query_reads_without_cameras():
+    # Attr.is_in([]) is invalid, so no query is made at all.
+    assert reconcile.query_reads(None, START, START + MS_PER_DAY, []) == []
+
+
+def test_queries_read_later_partitions():
+    backend = fakeaws.create_pipeline_backend()
+    # Processed, and so partitioned, the day after it was read.
+    late_ticket = dict(ticket('t1', 'ABC123', START + MS_PER_DAY - 1), days_since_epoch=DAY + 1)
+    backend['valet_table'].put_item(Item=late_ticket)
+    late_exit = dict(exit_read('e1', 'ABC123', START + MS_PER_DAY - 1), days_since_epoch=DAY + 1)
+    backend['lpr_table'].put_item(Item=late_exit)
+
+    for lag_days, expected in ((0, []), (1, ['t1'])):
+        tickets = reconcile.query_tickets(backend['valet_table'], START, START + MS_PER_DAY, lag_days)
+        assert [t['plate_read_id'] for t in tickets] == expected
+    for lag_days, expected in ((0, []), (1, ['e1'])):
+        reads = reconcile.query_reads(backend['lpr_table'], START, START + MS_PER_DAY, CAMERA_SITES, lag_days)
+        assert [read['plate_read_id'] for read in reads] == expected
@@ -0,0 +1,51 @@
+"""Tests for the valet tariff: charge per stay and the vectorized charges."""
+import pytest
+
+import tariff
+from tariff import MS_PER_DAY, MS_PER_HOUR
+
+ENTRY = 1_750_000_000_000
+
+# (stay in milliseconds, expected charge)
+STAYS = [
+    (-MS_PER_HOUR, 15),
+    (0, 15),
+    (2 * MS_PER_HOUR, 15),
+    (2 * MS_PER_HOUR + 1, 20),
+    (8 * MS_PER_HOUR, 20),
+    (8 * MS_PER_HOUR + 1, 24),
+    (12 * MS_PER_HOUR, 24),
+    (12 * MS_PER_HOUR + 1, 36),
+    (MS_PER_DAY, 36),
+    (MS_PER_DAY + 1, 36 + 15),
+    (MS_PER_DAY + 3 * MS_PER_HOUR, 36 + 20),
+    (2 * MS_PER_DAY, 72 + 15),
+    (2 * MS_PER_DAY + 1, 72 + 15),
+    (2 * MS_PER_DAY + 13 * MS_PER_HOUR, 72 + 36),
+]
+
+
+@pytest.mark.parametrize('stay_ms, expected', STAYS)
+def test_charge(stay_ms, expected):
+    assert tariff.charge(ENTRY, ENTRY + stay_ms) == expected
+
+
+def test_charge_accepts_decimal_timestamps():
+    from decimal import Decimal
+
+    assert tariff.charge(Decimal(ENTRY), Decimal(ENTRY + MS_PER_DAY + 1)) == 51
+
+
+@pytest.mark.parametrize('numpy_installed', [True, False])
+def test_charges_match_charge(monkeypatch, numpy_installed):
+    if numpy_installed:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(tariff, '_numpy', False)
+    entries = [ENTRY] * len(STAYS)
+    exits = [ENTRY + stay_ms for stay_ms, _ in STAYS]
+    assert [int(value) for value in tariff.charges(entries, exits)] == [expected for _, expected in STAYS]
+
+
+def test_charges_empty():
+    assert len(tariff.charges([], [])) == 0
@@ -0,0 +1,81 @@
+"""Tests for SightingsCache in valetsightings.py."""
+import pytest
+
+import fakeaws
+from valetsightings import SightingsCache
+
+MINUTE_MS = 60 * 1000
+DAY = 20_000
+BASE = DAY * 24 * 60 * MINUTE_MS + 12 * 60 * MINUTE_MS
+DAYS = [DAY, DAY - 1]
+VALET = '900 Valet'
+
+
+@pytest.fixture
+def backend():
+    return fakeaws.create_pipeline_backend()
+
+
+def queries(backend):
+    return backend['aws'].calls['dynamodb.Query']
+
+
+def sighting(backend, plate_read_id, plate, minute):
+    item = {'plate_read_id': plate_read_id, 'best_plate_number': plate, 'camera_label': VALET,
+            'plate_read_timestamp': BASE + minute * MINUTE_MS, 'days_since_epoch': DAY}
+    backend['lpr_table'].put_item(Item=item)
+    return item
+
+
+def window(start_minute, end_minute):
+    return BASE + start_minute * MINUTE_MS, BASE + end_minute * MINUTE_MS
+
+
+def test_disjoint_windows_stay_cached(backend):
+    cache = SightingsCache(backend['lpr_table'])
+    cache.load(DAYS, *window(0, 10))
+    cache.load(DAYS, *window(30, 40))
+    cache.load(DAYS, *window(0, 10))
+    cache.load(DAYS, *window(32, 38))
+    assert queries(backend) == 2 * len(DAYS)
+
+
+def test_overlapping_window_only_queries_the_new_part(backend):
+    cache = SightingsCache(backend['lpr_table'])
+    cache.load(DAYS, *window(0, 10))
+    cache.load(DAYS, *window(30, 40))
+    backend['aws'].reset_counts()
+    # Covers the gap between the two windows and runs past the second.
+    cache.load(DAYS, *window(5, 45))
+    assert queries(backend) == 2 * len(DAYS)
+    cache.load(DAYS, *window(0, 45))
+    assert queries(backend) == 2 * len(DAYS)
+
+
+def test_new_batch_requeries_the_unsettled_tail(backend):
+    cache = SightingsCache(backend['lpr_table'], settle_ms=5 * MINUTE_MS)
+    cache.load(DAYS, *window(0, 10))
+    late = sighting(backend, 'late', 'ABC123', 9)
+    cache.new_batch()
+    backend['aws'].reset_counts()
+    assert cache.find(VALET, ['ABC123'], DAYS, *window(0, 10)) == late
+    assert queries(backend) == len(DAYS)
+
+
+def test_find_returns_the_most_recent_sighting_in_the_window(backend):
+    sighting(backend, 'before', 'ABC123', -5)
+    sighting(backend, 'older', 'ABC123', 2)
+    newer = sighting(backend, 'newer', 'ABC123', 8)
+    cache = SightingsCache(backend['lpr_table'])
+    assert cache.find(VALET, ['XYZ789', 'ABC123'], DAYS, *window(0, 10)) == newer
+    assert cache.find('900 Garage Gate Entrance', ['ABC123'], DAYS, *window(0, 10)) is None
+
+
+def test_miss_queries_the_window_again(backend):
+    cache = SightingsCache(backend['lpr_table'])
+    cache.load(DAYS, *window(0, 10))
+    # Landed after its range was cached.
+    late = sighting(backend, 'late', 'ABC123', 3)
+    backend['aws'].reset_counts()
+    assert cache.find(VALET, ['ABC123'], DAYS, *window(0, 10)) == late
+    assert queries(backend) == len(DAYS)
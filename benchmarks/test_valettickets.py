@@ -0,0 +1,85 @@
+"""Tests for OpenTicketCache.close in valettickets.py."""
+import time
+
+import pytest
+
+import fakeaws
+from valettickets import CLOSED, EXIT_ALREADY_CHARGED, TICKET_ALREADY_CLOSED, OpenTicketCache
+
+MINUTE_MS = 60 * 1000
+
+
+@pytest.fixture
+def backend():
+    return fakeaws.create_pipeline_backend()
+
+
+def open_ticket(cache, plate_read_id, plate, timestamp):
+    ticket = {'plate_read_id': plate_read_id, 'best_plate_number': plate, 'plate_read_timestamp': timestamp,
+              'days_since_epoch': timestamp // (24 * 60 * MINUTE_MS), 'revenue_received': 0}
+    assert cache.open(ticket)
+    return cache.find([plate])
+
+
+def exit_key(backend, plate_read_id, timestamp):
+    backend['lpr_table'].put_item(Item={'plate_read_id': plate_read_id, 'plate_read_timestamp': timestamp})
+    return {'plate_read_id': plate_read_id, 'plate_read_timestamp': timestamp}
+
+
+def fail_once(monkeypatch, client, error):
+    transact_write_items = client.transact_write_items
+
+    def failing(**kwargs):
+        monkeypatch.setattr(client, 'transact_write_items', transact_write_items)
+        raise error
+
+    monkeypatch.setattr(client, 'transact_write_items', failing)
+
+
+@pytest.mark.parametrize('error', [
+    fakeaws.FakeClientError('ThrottlingException', 'TransactWriteItems'),
+    fakeaws.TransactionCanceledException(['None', 'TransactionConflict']),
+])
+def test_failed_close_keeps_the_ticket_for_the_retry(backend, monkeypatch, error):
+    cache = OpenTicketCache(backend['valet_table'], backend['lpr_table'])
+    now = int(time.time() * 1000)
+    ticket = open_ticket(cache, 't1', 'ABC123', now - 60 * MINUTE_MS)
+    key = exit_key(backend, 'e1', now)
+
+    fail_once(monkeypatch, backend['valet_table'].meta.client, error)
+    with pytest.raises(type(error)):
+        cache.close(ticket, 20, key)
+
+    # The redelivered exit still finds the ticket and charges it.
+    retried = cache.find(['ABC123'])
+    assert retried is not None and retried['plate_read_id'] == 't1'
+    assert cache.close(retried, 20, key) == CLOSED
+    assert cache.find(['ABC123']) is None
+    assert backend['valet_table'].get_item(Key={'plate_read_id': 't1', 'plate_read_timestamp': ticket['plate_read_timestamp']})['Item']['revenue_received'] == 20
+
+
+def test_redelivered_exit_keeps_the_next_ticket(backend):
+    cache = OpenTicketCache(backend['valet_table'], backend['lpr_table'])
+    now = int(time.time() * 1000)
+    open_ticket(cache, 'older', 'ABC123', now - 120 * MINUTE_MS)
+    newer = open_ticket(cache, 'newer', 'ABC123', now - 60 * MINUTE_MS)
+    first_exit = exit_key(backend, 'e1', now)
+    assert cache.close(newer, 20, first_exit) == CLOSED
+
+    # The redelivery finds the older ticket, but must not hide it from its own exit.
+    older = cache.find(['ABC123'])
+    assert older['plate_read_id'] == 'older'
+    assert cache.close(older, 20, first_exit) == EXIT_ALREADY_CHARGED
+    assert cache.find(['ABC123'])['plate_read_id'] == 'older'
+    assert cache.close(older, 24, exit_key(backend, 'e2', now + MINUTE_MS)) == CLOSED
+
+
+def test_ticket_closed_elsewhere_is_dropped(backend):
+    cache = OpenTicketCache(backend['valet_table'], backend['lpr_table'])
+    other = OpenTicketCache(backend['valet_table'], backend['lpr_table'])
+    now = int(time.time() * 1000)
+    ticket = open_ticket(cache, 't1', 'ABC123', now - 60 * MINUTE_MS)
+    assert other.close(ticket, 20, exit_key(backend, 'e1', now)) == CLOSED
+
+    assert cache.close(ticket, 20, exit_key(backend, 'e2', now + MINUTE_MS)) == TICKET_ALREADY_CLOSED
+    assert cache.find(['ABC123']) is None